@@ -0,0 +1,27 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    # stands in for a module until the first attribute access imports it,
+    # keeps `import clip_interrogator` from pulling in torch and friends
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    return LazyModule(name)
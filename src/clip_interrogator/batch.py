@@ -0,0 +1,369 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from functools import partial
+from typing import Iterable, Iterator, List, Tuple
+from PIL import Image
+from .budget import Budget
+from .dedup import DedupIndex
+from .index import ImageIndex
+from .pipeline import load_image, prefetch_images
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# batch mode name -> ClipInterrogator method, 'caption' only runs BLIP
+MODES = {
+    'best': 'interrogate',
+    'classic': 'interrogate_classic',
+    'fast': 'interrogate_fast',
+    'flavors': 'interrogate_flavors',
+    'caption': None,
+}
+
+RECORD_FIELDS = ['path', 'hash', 'mode', 'prompt', 'error', 'duplicate_of', 'budget']
+
+
+def iter_images(source_dir: str) -> Iterator[str]:
+    # sorted walk so every run sees files in the same order
+    for root, dirs, files in os.walk(os.path.abspath(source_dir)):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, file)
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_hashed_image(path: str, draft_size: int = None) -> Tuple[Image.Image, str]:
+    # the file is read once for both the content hash and the decode
+    with open(path, 'rb') as f:
+        data = f.read()
+    return load_image(io.BytesIO(data), draft_size), hashlib.sha256(data).hexdigest()
+
+
+def interrogate_images(ci, images: List[Image.Image], mode: str = 'best', max_flavors: int = None, image_features=None,
+                       reports: list = None) -> List[str]:
+    # captions and image features for the whole batch go through BLIP and CLIP in one forward pass,
+    # `reports` receives the budget report of every image, None unless the best mode runs with config budgets
+    if mode not in MODES:
+        raise Exception(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+    kwargs = {} if max_flavors is None else {'max_flavors': max_flavors}
+    budgeted = mode == 'best' and (ci.config.time_budget is not None or ci.config.compute_budget is not None)
+    if reports is not None and not budgeted:
+        reports.extend([None] * len(images))
+    if mode == 'caption':
+        return ci.generate_captions(images)
+
+    if image_features is None:
+        image_features = ci.images_to_features(images)
+    if mode == 'flavors':
+        return [ci.interrogate_flavors(image, image_features=image_features[i:i+1], **kwargs) for i, image in enumerate(images)]
+
+    captions = ci.generate_captions(images)
+    method = getattr(ci, MODES[mode])
+    prompts = []
+    for i, image in enumerate(images):
+        if budgeted:
+            kwargs['budget'] = Budget(ci.config.time_budget, ci.config.compute_budget)
+        prompts.append(method(image, caption=captions[i], image_features=image_features[i:i+1], **kwargs))
+        if budgeted and reports is not None:
+            reports.append(kwargs['budget'].report())
+    return prompts
+
+
+def interrogate_deduplicated(ci, index: DedupIndex, images: List[Image.Image], paths: List[str], mode: str = 'best',
+                             max_flavors: int = None, image_features=None, reports: list = None) -> Tuple[List[str], List[str]]:
+    """
+    Like interrogate_images, but images within the index threshold of an
+    earlier one reuse its prompt. Only representatives run BLIP and the
+    flavor chain. Returns the prompts and, per image, the path of the
+    representative it was copied from or None. Copies get no budget report.
+    """
+    if image_features is None:
+        image_features = ci.images_to_features(images)
+    known = index.count
+    reps = index.assign(image_features)
+
+    # new representatives, and images whose representative failed earlier
+    run_rows, new = [], set()
+    for row, rep in enumerate(reps):
+        if rep >= known and rep not in new:
+            new.add(rep)
+            index.values[rep] = {'path': paths[row], 'prompt': None}
+            run_rows.append(row)
+        elif rep < known and index.values[rep]['prompt'] is None:
+            run_rows.append(row)
+
+    prompts, duplicate_of, run_reports = [None] * len(images), [None] * len(images), [None] * len(images)
+    if run_rows:
+        budgets = []
+        results = interrogate_images(ci, [images[row] for row in run_rows], mode, max_flavors, image_features[run_rows], budgets)
+        for row, prompt, report in zip(run_rows, results, budgets):
+            prompts[row], run_reports[row] = prompt, report
+            if index.values[reps[row]]['path'] == paths[row]:
+                index.values[reps[row]]['prompt'] = prompt
+    for row, rep in enumerate(reps):
+        if prompts[row] is None:
+            prompts[row] = index.values[rep]['prompt']
+            duplicate_of[row] = index.values[rep]['path']
+    if reports is not None:
+        reports.extend(run_reports)
+    return prompts, duplicate_of
+
+
+class Manifest():
+    """
+    Append-only record of finished files. A file counts as done while its
+    size and mtime match the entry, so reruns skip it without rereading it.
+    With `verify_hash` a file whose size and mtime match is also reread and
+    must still have the recorded content hash, which catches same-size
+    rewrites with a restored mtime. Otherwise the hash is informational.
+    """
+    def __init__(self, path: str, verify_hash: bool = False):
+        self.path = path
+        self.verify_hash = verify_hash
+        self.done = {} # path -> (size, mtime, hash)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # torn last line of an interrupted run
+                    self.done[entry['path']] = (entry['size'], entry['mtime'], entry.get('hash'))
+        self.file = _open_append(path)
+        self.pending = []
+
+    def is_done(self, path: str) -> bool:
+        entry = self.done.get(path)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if entry[:2] != (stat.st_size, stat.st_mtime):
+            return False
+        if not self.verify_hash:
+            return True
+        try:
+            return _file_hash(path) == entry[2]
+        except OSError:
+            return False
+
+    def add(self, path: str, digest: str):
+        stat = os.stat(path)
+        self.pending.append({'path': path, 'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime})
+
+    def flush(self):
+        for entry in self.pending:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.done[entry['path']] = (entry['size'], entry['mtime'], entry['hash'])
+        self.pending = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class JsonlWriter():
+    def __init__(self, path: str):
+        self.path = path
+        self.file = _open_append(path)
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class ParquetWriter():
+    """
+    Parquet files are only readable once their footer is written, so every
+    flush writes a complete numbered file next to `path` (out.00000.parquet, ...).
+    """
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("Parquet output requires pyarrow, install it with `pip install pyarrow`")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in RECORD_FIELDS])
+        self.prefix = path[:-len('.parquet')] if path.endswith('.parquet') else path
+        self.index = 0
+        self.rows = []
+
+    def write(self, record: dict):
+        self.rows.append(record)
+
+    def flush(self):
+        if not self.rows:
+            return
+        while os.path.exists(self._part_path()):
+            self.index += 1
+        path = self._part_path()
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        os.close(fd)
+        self.pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def _part_path(self) -> str:
+        return f"{self.prefix}.{self.index:05d}.parquet"
+
+
+def open_writer(path: str, format: str = None):
+    format = format or ('parquet' if path.endswith('.parquet') else 'jsonl')
+    if format == 'parquet':
+        return ParquetWriter(path)
+    if format == 'jsonl':
+        return JsonlWriter(path)
+    raise Exception(f"Unknown output format {format}, expected jsonl or parquet")
+
+
+def run_batch(ci, paths: Iterable[str], output: str, mode: str = 'best', format: str = None,
+              batch_size: int = 8, workers: int = 4, prefetch: int = None, max_flavors: int = None,
+              flush_every: int = 1000, flush_interval: float = 60.0, manifest_path: str = None,
+              draft_size: int = None, dedup_threshold: float = None, index_path: str = None,
+              verify_hash: bool = False) -> dict:
+    """
+    Interrogates `paths` and streams one record per image to `output`.
+    Records are flushed every `flush_every` images or `flush_interval` seconds,
+    and only then are the images added to the manifest, so an interrupted run
+    resumes after the last flush. Failed images are not added, every rerun
+    retries them and appends a new record, so output can hold several records
+    per path. shard.merge_outputs keeps one per path, preferring successes.
+
+    Args:
+        ci (ClipInterrogator): interrogator, prepare_labels must have been called for every mode except caption and flavors
+        paths (iterable): image files, consumed lazily
+        output (str): .jsonl or .parquet output path
+        mode (str): one of MODES
+        batch_size (int): images per BLIP and CLIP forward pass
+        workers (int): decode threads
+        prefetch (int): decoded images queued ahead of the model, defaults to 4 batches
+        dedup_threshold (float): when set, images whose CLIP features are within this cosine
+            similarity of an earlier image of the run copy its prompt, see interrogate_deduplicated
+        index_path (str): directory of an index.ImageIndex the CLIP image features of
+            interrogated images are appended to, flushed along with the output
+        verify_hash (bool): reread files the manifest lists and skip them only if their content hash matches
+    """
+    manifest = Manifest(manifest_path or output + '.manifest.jsonl', verify_hash)
+    writer = open_writer(output, format)
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0}
+    index = None
+    if dedup_threshold is not None:
+        index = DedupIndex(dedup_threshold)
+        stats.update(duplicates=0, representatives=0, saved_fraction=0.0)
+    image_index = ImageIndex(index_path, ci.config.clip_model_name) if index_path is not None else None
+
+    def todo():
+        for path in paths:
+            if manifest.is_done(path):
+                stats['skipped'] += 1
+                continue
+            yield path
+
+    def run(batch):
+        images, reports = [image for _, image, _ in batch], []
+        try:
+            image_features = ci.images_to_features(images) if image_index is not None else None
+            if index is None:
+                prompts, duplicate_of = interrogate_images(ci, images, mode, max_flavors, image_features, reports), [None] * len(batch)
+            else:
+                prompts, duplicate_of = interrogate_deduplicated(ci, index, images, [path for path, _, _ in batch], mode, max_flavors, image_features, reports)
+        except Exception as e:
+            for path, _, digest in batch:
+                writer.write(_record(path, digest, mode, error=str(e)))
+                stats['failed'] += 1
+            return
+        for (path, _, digest), prompt, original, report in zip(batch, prompts, duplicate_of, reports):
+            writer.write(_record(path, digest, mode, prompt=prompt, duplicate_of=original, budget=report))
+            manifest.add(path, digest)
+            stats['processed'] += 1
+        if image_index is not None:
+            image_index.add([path for path, _, _ in batch], image_features)
+        if index is not None:
+            stats['duplicates'] += sum(original is not None for original in duplicate_of)
+            stats['representatives'] = index.count
+            stats['saved_fraction'] = stats['duplicates'] / stats['processed']
+
+    def flush():
+        # output first, manifest second: a crash in between only repeats work
+        writer.flush()
+        if image_index is not None:
+            image_index.flush()
+        manifest.flush()
+
+    batch, last_flush = [], time.time()
+    try:
+        # the BLIP and CLIP transforms run on the decode threads too
+        prepare = partial(_prepare_loaded, ci, mode != 'flavors', mode != 'caption' or image_index is not None or index is not None)
+        for path, loaded, error in prefetch_images(todo(), workers, prefetch or batch_size * 4, draft_size,
+                                                   loader=load_hashed_image, prepare=prepare):
+            if error is not None:
+                writer.write(_record(path, None, mode, error=str(error)))
+                stats['failed'] += 1
+                continue
+            batch.append((path, *loaded))
+            if len(batch) >= batch_size:
+                run(batch)
+                batch = []
+            if len(manifest.pending) >= flush_every or time.time() - last_flush >= flush_interval:
+                flush()
+                last_flush = time.time()
+        if batch:
+            run(batch)
+    finally:
+        writer.close()
+        if image_index is not None:
+            image_index.flush()
+        manifest.close()
+    return stats
+
+
+def _prepare_loaded(ci, blip: bool, clip: bool, loaded: Tuple[Image.Image, str]):
+    image, digest = loaded
+    return ci.prepare_image(image, blip, clip), digest
+
+
+def _record(path: str, digest: str, mode: str, prompt: str = None, error: str = None, duplicate_of: str = None,
+            budget: dict = None) -> dict:
+    # the budget report is a json string, like every other column of the parquet schema
+    return {'path': path, 'hash': digest, 'mode': mode, 'prompt': prompt, 'error': error, 'duplicate_of': duplicate_of,
+            'budget': json.dumps(budget) if budget is not None else None}
+
+
+def _open_append(path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b'\n'
+    f = open(path, 'a', encoding='utf-8')
+    if torn:
+        f.write('\n')
+    return f
@@ -0,0 +1,117 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Callable, Iterable, List
+
+# modes timed end to end, with the image cache off so every call runs the models
+MODES = ['interrogate', 'interrogate_classic', 'interrogate_fast', 'interrogate_flavors']
+
+
+def time_call(fn: Callable, repeat: int = 3, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'median_ms': statistics.median(times),
+        'min_ms': min(times),
+        'mean_ms': statistics.mean(times),
+        'repeat': len(times),
+    }
+
+
+def run_benchmark(label_counts: Iterable[int] = (64, 1024), batch_sizes: Iterable[int] = (1, 4), repeat: int = 3,
+                  warmup: int = 1, max_flavors: int = 8, seed: int = 0, chunk_size: int = 256, **config_overrides) -> dict:
+    """
+    Times every stage of the interrogator on the tiny random-weight models from
+    `testing`, so it runs offline on cpu. Label tables hold the first
+    `label_count` entries of each bundled list. The small default `chunk_size`
+    makes the larger tables go through the chunked rank and encode paths.
+
+    Returns {"meta": {...}, "results": [{"name", "labels", "batch_size", "median_ms", ...}]}.
+    """
+    import torch
+    from .clip_interrogator import ClipInterrogator, LabelTable, _load_list
+    from .testing import random_images, tiny_config
+
+    results = []
+    def record(name: str, labels: int, batch_size: int, timing: dict):
+        results.append({'name': name, 'labels': labels, 'batch_size': batch_size, **timing})
+
+    images = random_images(max(batch_sizes), seed=seed)
+    for label_count in label_counts:
+        with tempfile.TemporaryDirectory() as cache_path:
+            config = tiny_config(cache_path, label_count=label_count, seed=seed, chunk_size=chunk_size, **config_overrides)
+            ci = ClipInterrogator(config)
+            labels = _load_list(config.data_path, 'flavors.txt')
+            record('label_table_build', label_count, 1, time_call(
+                lambda: LabelTable(labels, None, ci.clip_model, ci.tokenize, config), repeat, warmup))
+            record('prepare_labels', label_count, 1, time_call(ci.prepare_labels, 1, 0))
+            record('prepare_labels_cached', label_count, 1, time_call(ci.prepare_labels, repeat, warmup))
+
+            image_features = ci.image_to_features(images[0])
+            record('rank', label_count, 1, time_call(lambda: ci.flavors.rank(image_features, max_flavors), repeat, warmup))
+            caption = ci.generate_caption(images[0])
+            record('flavor_chain', label_count, 1, time_call(
+                lambda: ci.interrogate(images[0], max_flavors, caption=caption, image_features=image_features), repeat, warmup))
+            for mode in MODES:
+                method = getattr(ci, mode)
+                record(mode, label_count, 1, time_call(lambda: method(images[0], max_flavors=max_flavors), repeat, warmup))
+
+    # the vision models do not depend on the label tables, `ci` is the last one built
+    for batch_size in batch_sizes:
+        batch = images[:batch_size]
+        record('generate_caption', 0, batch_size, time_call(lambda: ci.generate_captions(batch), repeat, warmup))
+        record('image_to_features', 0, batch_size, time_call(lambda: ci.images_to_features(batch), repeat, warmup))
+
+    return {'meta': {**_meta(torch, seed), 'chunk_size': chunk_size}, 'results': results}
+
+
+def compare(baseline: dict, current: dict, threshold: float = 1.1) -> List[dict]:
+    """
+    Matches results by (name, labels, batch_size) and returns the ones whose
+    median got slower than `threshold` times the baseline.
+    """
+    key = lambda r: (r['name'], r['labels'], r['batch_size'])
+    before = {key(r): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None or old['median_ms'] <= 0:
+            continue
+        ratio = result['median_ms'] / old['median_ms']
+        if ratio > threshold:
+            regressions.append({'name': result['name'], 'labels': result['labels'], 'batch_size': result['batch_size'],
+                                'baseline_ms': old['median_ms'], 'median_ms': result['median_ms'], 'ratio': ratio})
+    return regressions
+
+
+def write_results(results: dict, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+
+def _meta(torch, seed: int) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'threads': torch.get_num_threads(),
+        'seed': seed,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
@@ -10,7 +10,8 @@ warnings.filterwarnings("ignore")
 
 from .vit import VisionTransformer, interpolate_pos_embed
 from .med import BertConfig, BertModel, BertLMHeadModel
-from transformers import BertTokenizer
+from transformers import BertTokenizerFast
+from tokenizers.implementations import BertWordPieceTokenizer
 
 import torch
 from torch import nn
@@ -90,17 +91,16 @@ class BLIP_Decoder(nn.Module):
                  ):
         """
         Args:
-            med_config (str): path for the mixture of encoder-decoder model's configuration file
+            med_config (str or BertConfig): path for the mixture of encoder-decoder model's configuration file
             image_size (int): input image size
             vit (str): model size of vision transformer
         """            
         super().__init__()
 
-        med_config = f"{blip_path}/{med_config}"
-        
         self.visual_encoder, vision_width = create_vit(vit,image_size, vit_grad_ckpt, vit_ckpt_layer)
         self.tokenizer = init_tokenizer()   
-        med_config = BertConfig.from_json_file(med_config)
+        if not isinstance(med_config, BertConfig):
+            med_config = BertConfig.from_json_file(f"{blip_path}/{med_config}")
         med_config.encoder_width = vision_width
         self.text_decoder = BertLMHeadModel(config=med_config)    
         
@@ -190,7 +190,9 @@ def blip_feature_extractor(pretrained='',**kwargs):
     return model        
 
 def init_tokenizer():
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+    # bert-base-uncased vocab ships with the package so building BLIP never touches the hub
+    wordpiece = BertWordPieceTokenizer(f"{blip_path}/bert-base-uncased-vocab.txt", lowercase=True)
+    tokenizer = BertTokenizerFast(tokenizer_object=wordpiece._tokenizer)
     tokenizer.add_special_tokens({'bos_token':'[DEC]'})
     tokenizer.add_special_tokens({'additional_special_tokens':['[ENC]']})       
     tokenizer.enc_token_id = tokenizer.additional_special_tokens_ids[0]  
@@ -199,13 +201,20 @@ def init_tokenizer():
 
 def create_vit(vit, image_size, use_grad_checkpointing=False, ckpt_layer=0, drop_path_rate=0):
         
-    assert vit in ['base', 'large'], "vit parameter must be base or large"
+    assert vit in ['tiny', 'base', 'large'], "vit parameter must be tiny, base or large"
     if vit=='base':
         vision_width = 768
         visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=12, 
                                            num_heads=12, use_grad_checkpointing=use_grad_checkpointing, ckpt_layer=ckpt_layer,
                                            drop_path_rate=0 or drop_path_rate
                                           )   
+    elif vit=='tiny':
+        # random-weight stand-in for tests and benchmarks, there is no pretrained checkpoint
+        vision_width = 64
+        visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=2, 
+                                           num_heads=2, use_grad_checkpointing=use_grad_checkpointing, ckpt_layer=ckpt_layer,
+                                           drop_path_rate=0 or drop_path_rate
+                                          )   
     elif vit=='large':
         vision_width = 1024
         visual_encoder = VisionTransformer(img_size=image_size, patch_size=16, embed_dim=vision_width, depth=24, 
@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+
+
+class Budget():
+    """
+    Limits how much work `interrogate` spends improving its prompt. When the
+    budget runs out the remaining candidate batches are skipped and the best
+    prompt found so far is returned. Pass your own instance to read how far
+    the search got:
+
+        budget = Budget(seconds=0.5)
+        prompt = ci.interrogate(image, budget=budget)
+        budget.report()  # {"exhausted": True, "stopped_in": "flavor_chain", "flavors": 4, ...}
+
+    Args:
+        seconds (float): wall time, counted from creation of the budget, without
+            the time interrogate_iter's caller spends on each step
+        texts (int): candidate prompts encoded by CLIP
+    """
+    def __init__(self, seconds: float = None, texts: int = None):
+        self.seconds = seconds
+        self.texts = texts
+        self.start = time.perf_counter()
+        self.encoded = 0
+        self.stage = None
+        self.stopped_in = None
+        self.progress = {}
+
+    @property
+    def exhausted(self) -> bool:
+        if self.texts is not None and self.encoded >= self.texts:
+            return True
+        return self.seconds is not None and time.perf_counter() - self.start >= self.seconds
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def suspended(self):
+        # the wall clock stops while interrogate_iter's caller holds a step
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.start += time.perf_counter() - start
+
+    def charge(self, texts: int):
+        self.encoded += texts
+
+    def stop(self):
+        # first stage that skipped work
+        if self.stopped_in is None:
+            self.stopped_in = self.stage
+
+    def report(self) -> dict:
+        return {
+            'exhausted': self.stopped_in is not None,
+            'stopped_in': self.stopped_in,
+            'seconds': self.elapsed,
+            'texts': self.encoded,
+            **self.progress,
+        }
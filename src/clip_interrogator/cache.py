@@ -0,0 +1,115 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+def image_hash(image: Image.Image) -> str:
+    # hash of the decoded pixels so re-encoded copies of the same file share entries
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class MemoryCache():
+    """
+    Args:
+        max_bytes (int): approximate size bound, least recently used entries are evicted first
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def set(self, key: str, value):
+        nbytes = _sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+
+class DiskCache():
+    """
+    Args:
+        path (str): directory holding one pickle per entry, safe to share between processes
+        max_bytes (int): size bound, entries with the oldest access time are evicted first
+    """
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.sizes = {}
+        for root, _, files in os.walk(path):
+            for file in files:
+                if file.endswith('.pkl'):
+                    filepath = os.path.join(root, file)
+                    self.sizes[filepath] = os.path.getsize(filepath)
+        self.size = sum(self.sizes.values())
+
+    def get(self, key: str):
+        filepath = self._filepath(key)
+        try:
+            with open(filepath, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(filepath)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key: str, value):
+        filepath = self._filepath(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, filepath)
+        with self.lock:
+            self.size += os.path.getsize(filepath) - self.sizes.get(filepath, 0)
+            self.sizes[filepath] = os.path.getsize(filepath)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        def last_access(filepath):
+            try:
+                return os.stat(filepath).st_mtime
+            except OSError:
+                return 0
+        for filepath in sorted(self.sizes, key=last_access):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            self.size -= self.sizes.pop(filepath)
+
+    def _filepath(self, key: str) -> str:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, name[:2], name + '.pkl')
+
+
+def _sizeof(value) -> int:
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, str):
+        return len(value)
+    return len(pickle.dumps(value))
@@ -0,0 +1,334 @@
+import argparse
+import json
+import sys
+from .batch import MODES, iter_images, run_batch
+from .shard import launch, merge_outputs, parse_shard, shard_output_path, shard_paths
+
+
+def build_interrogator(args, labels: bool = True, overrides: dict = None):
+    from .clip_interrogator import ClipInterrogator, Config
+    if getattr(args, 'tiny', False):
+        from .testing import tiny_config
+        config = tiny_config(args.cache_path, label_count=args.tiny_labels, **(overrides or {}))
+        ci = ClipInterrogator(config)
+        if labels:
+            ci.prepare_labels()
+        return ci
+    config = Config(
+        blip_image_eval_size=args.blip_image_eval_size,
+        cache_path=args.cache_path,
+        chunk_size=args.chunk_size,
+        clip_model_name=args.model,
+        compute_budget=args.compute_budget,
+        flavor_intermediate_count=args.flavor_intermediate_count,
+        flavor_prune_count=args.flavor_prune_count,
+        image_cache_path=args.image_cache,
+        quantize=args.quantize,
+        quiet=True,
+        time_budget=args.time_budget,
+    )
+    for key, value in (overrides or {}).items():
+        setattr(config, key, value)
+    if args.device:
+        config.device = args.device
+    ci = ClipInterrogator(config)
+    if labels:
+        ci.prepare_labels()
+    return ci
+
+
+def add_model_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--model", default="ViT-L-14/openai", help="open_clip model name and pretrained tag")
+    parser.add_argument("--device", default=None, help="defaults to cuda when available")
+    parser.add_argument("--cache-path", default="cache", help="model checkpoint and label embedding cache")
+    parser.add_argument("--image-cache", default=None, help="directory caching captions and image features")
+    parser.add_argument("--blip-image-eval-size", type=int, default=384)
+    parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization, cpu only")
+    parser.add_argument("--chunk-size", type=int, default=2048, help="labels encoded and ranked per pass")
+    parser.add_argument("--flavor-intermediate-count", type=int, default=2048, help="flavors kept for the best mode's flavor chain")
+    parser.add_argument("--flavor-prune-count", type=int, default=None, help="diversified flavors the best mode's chain starts from, see Config.flavor_prune_count")
+    parser.add_argument("--time-budget", type=float, default=None, help="seconds per image after which the best mode returns its prompt so far")
+    parser.add_argument("--compute-budget", type=int, default=None, help="candidate prompts the best mode encodes per image at most")
+
+
+def batch(args):
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    paths, output, manifest = iter_images(args.source_dir), args.output, args.manifest
+    if args.shard:
+        index, count = parse_shard(args.shard)
+        paths = shard_paths(paths, args.source_dir, index, count)
+        output = shard_output_path(output, index, count)
+        manifest = shard_output_path(manifest, index, count) if manifest else None
+
+    ci = build_interrogator(args, labels=args.mode not in ('caption', 'flavors'))
+    stats = run_batch(
+        ci,
+        paths,
+        output,
+        mode=args.mode,
+        format=args.format,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        prefetch=args.prefetch,
+        max_flavors=args.max_flavors,
+        flush_every=args.flush_every,
+        flush_interval=args.flush_interval,
+        manifest_path=manifest,
+        draft_size=args.blip_image_eval_size,
+        dedup_threshold=args.dedup_threshold,
+        index_path=args.index,
+        verify_hash=args.verify_hash,
+    )
+    print(json.dumps(stats), file=sys.stderr)
+
+
+def merge(args):
+    stats = merge_outputs(args.inputs, args.output)
+    print(json.dumps(stats), file=sys.stderr)
+
+
+def launch_workers(args):
+    batch_argv = args.batch_args[1:] if args.batch_args[:1] == ['--'] else args.batch_args
+    sys.exit(launch(batch_argv, args.procs, parse_shard(args.node)))
+
+
+def serve(args):
+    from .serve import make_server
+    ci = build_interrogator(args)
+    server = make_server(
+        ci,
+        host=args.host,
+        port=args.port,
+        batch_size=args.batch_size,
+        max_wait=args.max_wait,
+        queue_size=args.queue_size,
+        result_cache_size=args.result_cache_size,
+        draft_size=args.blip_image_eval_size,
+    )
+    print(f"Serving on http://{server.server_address[0]}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.scheduler.close()
+        ci.close()
+
+
+def benchmark(args):
+    from .benchmark import compare, run_benchmark, write_results
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    results = run_benchmark(
+        label_counts=[int(x) for x in args.labels.split(',')],
+        batch_sizes=[int(x) for x in args.batch_sizes.split(',')],
+        repeat=args.repeat,
+        warmup=args.warmup,
+        max_flavors=args.max_flavors,
+        chunk_size=args.chunk_size,
+        quantize=args.quantize,
+    )
+    write_results(results, args.output)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for r in regressions:
+            print(f"{r['name']} labels={r['labels']} batch={r['batch_size']}: "
+                  f"{r['baseline_ms']:.1f}ms -> {r['median_ms']:.1f}ms ({r['ratio']:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def profile(args):
+    from .batch import interrogate_images
+    from .pipeline import load_image
+    from .profiling import MemoryProfiler
+    images = [load_image(path) for path in args.images]
+    with MemoryProfiler(cpu_allocations=args.cpu_allocations) as profiler:
+        ci = build_interrogator(args, labels=args.mode not in ('caption', 'flavors'))
+        for image in images:
+            interrogate_images(ci, [image], args.mode, args.max_flavors)
+    print(profiler.summary())
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(profiler.report(), f, indent=2)
+
+
+def video(args):
+    from dataclasses import asdict
+    from .video import interrogate_frames, read_video
+    ci = build_interrogator(args, labels=args.mode not in ('caption', 'flavors'))
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        frames = read_video(args.path, args.every)
+        for segment in interrogate_frames(ci, frames, args.mode, args.threshold, args.batch_size, args.max_flavors):
+            output.write(json.dumps(asdict(segment), ensure_ascii=False) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def search(args):
+    from .index import ImageIndex
+    from .pipeline import load_image
+    if (args.text is None) == (args.image is None):
+        raise Exception("Pass either a text query or --image")
+    ci = build_interrogator(args, labels=False)
+    index = ImageIndex(args.index, ci.config.clip_model_name)
+    query = args.text if args.image is None else load_image(args.image)
+    for id, score in index.search(ci, query, args.top):
+        print(json.dumps({'id': id, 'similarity': score}, ensure_ascii=False))
+
+
+def parse_overrides(items: list) -> dict:
+    # key=value, values are parsed as JSON when they can be (true, 512, 0.5) and kept as strings otherwise
+    from dataclasses import fields
+    from .clip_interrogator import Config
+    names = {f.name for f in fields(Config)}
+    overrides = {}
+    for item in items or []:
+        key, sep, value = item.partition('=')
+        if not sep or key not in names:
+            raise Exception(f"Invalid override {item}, expected a Config field as key=value")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def evaluate(args):
+    from .evaluate import evaluate as run_evaluation
+    from .pipeline import load_image
+    from .testing import random_images
+    images = [load_image(path) for path in args.images]
+    images += random_images(args.synthetic, seed=args.seed) if args.synthetic else []
+    if not images:
+        raise Exception("No images, pass image paths or --synthetic N")
+
+    reference = build_interrogator(args, overrides=parse_overrides(args.reference))
+    candidate_overrides = parse_overrides(args.candidate)
+    candidate = build_interrogator(args, overrides=candidate_overrides) if candidate_overrides else reference
+    report = run_evaluation(reference, candidate, images, mode=args.mode, candidate_mode=args.candidate_mode,
+                            top_count=args.top_count, max_flavors=args.max_flavors)
+    summary = {key: report[key] for key in report if key != 'images'}
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="clip-interrogator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("batch", help="interrogate a directory of images into JSONL or Parquet")
+    p.add_argument("source_dir")
+    p.add_argument("-o", "--output", required=True, help=".jsonl or .parquet output path")
+    p.add_argument("--format", choices=["jsonl", "parquet"], default=None, help="defaults to the output extension")
+    p.add_argument("--mode", choices=list(MODES), default="best")
+    p.add_argument("--max-flavors", type=int, default=None)
+    p.add_argument("--batch-size", type=int, default=8, help="images per BLIP and CLIP forward pass")
+    p.add_argument("--workers", type=int, default=4, help="image decode threads")
+    p.add_argument("--prefetch", type=int, default=None, help="decoded images queued ahead of the model")
+    p.add_argument("--flush-every", type=int, default=1000, help="flush output and manifest every N images")
+    p.add_argument("--flush-interval", type=float, default=60.0, help="or every N seconds")
+    p.add_argument("--manifest", default=None, help="defaults to <output>.manifest.jsonl")
+    p.add_argument("--verify-hash", action="store_true", help="reread finished files on resume and redo the ones whose content changed")
+    p.add_argument("--shard", default=None, help="i/N, only interrogate the i-th of N disjoint path-hash partitions")
+    p.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    p.add_argument("--dedup-threshold", type=float, default=None, help="copy the prompt of an earlier image whose CLIP features are this cosine similar, e.g. 0.95")
+    p.add_argument("--index", default=None, help="also append CLIP image features to the image index in this directory, see search")
+    add_model_arguments(p)
+    p.set_defaults(func=batch)
+
+    p = commands.add_parser("merge", help="combine per-shard outputs, one record per path")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("-o", "--output", required=True, help=".jsonl or .parquet output path")
+    p.set_defaults(func=merge)
+
+    p = commands.add_parser("launch", help="run one batch worker per core group on this host")
+    p.add_argument("--procs", type=int, default=1, help="worker processes, cores are split evenly between them")
+    p.add_argument("--node", default="0/1", help="i/N, this host's index when N hosts share the walk")
+    p.add_argument("batch_args", nargs=argparse.REMAINDER, help="arguments passed on to batch, after --")
+    p.set_defaults(func=launch_workers)
+
+    p = commands.add_parser("serve", help="serve the interrogate, flavors and score modes over HTTP")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--batch-size", type=int, default=8, help="requests per BLIP and CLIP forward pass")
+    p.add_argument("--max-wait", type=float, default=0.01, help="seconds a partial batch waits for more requests")
+    p.add_argument("--queue-size", type=int, default=64, help="queued requests per priority lane before answering 429")
+    p.add_argument("--result-cache-size", type=int, default=64 * 1024 * 1024, help="bytes of cached results")
+    add_model_arguments(p)
+    p.set_defaults(func=serve)
+
+    p = commands.add_parser("benchmark", help="time every stage on tiny random-weight models, offline")
+    p.add_argument("-o", "--output", default="benchmark.json")
+    p.add_argument("--labels", default="64,1024", help="comma separated label table sizes")
+    p.add_argument("--batch-sizes", default="1,4", help="comma separated BLIP and CLIP image batch sizes")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--warmup", type=int, default=1)
+    p.add_argument("--max-flavors", type=int, default=8)
+    p.add_argument("--chunk-size", type=int, default=256, help="labels encoded and ranked per pass, below the largest table size so the chunked rank is timed")
+    p.add_argument("--quantize", action="store_true", help="dynamic int8 quantization")
+    p.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    p.add_argument("--compare", default=None, help="baseline JSON, exits non-zero when a stage got slower")
+    p.add_argument("--threshold", type=float, default=1.1, help="slowdown ratio counted as a regression")
+    p.set_defaults(func=benchmark)
+
+    p = commands.add_parser("profile", help="peak memory and time per stage and label table")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--mode", choices=list(MODES), default="best")
+    p.add_argument("--max-flavors", type=int, default=None)
+    p.add_argument("-o", "--output", default=None, help="also write the report as JSON")
+    p.add_argument("--cpu-allocations", action="store_true", help="also record cpu tensor allocations per stage with torch.profiler, slows every op down")
+    add_model_arguments(p)
+    p.set_defaults(func=profile)
+
+    p = commands.add_parser("video", help="one prompt per scene of a video file, streamed as JSONL")
+    p.add_argument("path")
+    p.add_argument("-o", "--output", default=None, help="JSONL output, defaults to stdout")
+    p.add_argument("--mode", choices=list(MODES), default="best")
+    p.add_argument("--max-flavors", type=int, default=None)
+    p.add_argument("--threshold", type=float, default=0.9, help="cosine similarity to the scene's first frame below which a new scene starts")
+    p.add_argument("--every", type=int, default=1, help="only look at every N-th frame")
+    p.add_argument("--batch-size", type=int, default=8, help="frames per CLIP image feature pass")
+    add_model_arguments(p)
+    p.set_defaults(func=video)
+
+    p = commands.add_parser("search", help="rank the images of an index built by batch --index against a text or an image")
+    p.add_argument("index")
+    p.add_argument("text", nargs="?", default=None)
+    p.add_argument("--image", default=None, help="search by image instead of text")
+    p.add_argument("--top", type=int, default=10)
+    add_model_arguments(p)
+    p.set_defaults(func=search)
+
+    p = commands.add_parser("evaluate", help="recall and latency of a candidate configuration against the reference")
+    p.add_argument("images", nargs="*")
+    p.add_argument("--synthetic", type=int, default=0, help="add N random images")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--mode", choices=[mode for mode, method in MODES.items() if method], default="best", help="reference mode")
+    p.add_argument("--candidate-mode", choices=[mode for mode, method in MODES.items() if method], default=None, help="defaults to --mode")
+    p.add_argument("--reference", action="append", default=[], metavar="KEY=VALUE", help="Config override for the reference")
+    p.add_argument("--candidate", action="append", default=[], metavar="KEY=VALUE", help="Config override for the candidate, e.g. chunk_size=512")
+    p.add_argument("--top-count", type=int, default=10, help="ranked labels compared per table")
+    p.add_argument("--max-flavors", type=int, default=32)
+    p.add_argument("--tiny", action="store_true", help="tiny random-weight models, runs offline")
+    p.add_argument("--tiny-labels", type=int, default=256, help="labels per table with --tiny")
+    p.add_argument("-o", "--output", default=None, help="write the full report, with every image, as JSON")
+    add_model_arguments(p)
+    p.set_defaults(func=evaluate)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,43 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
 import hashlib
 import math
-import numpy as np
-import open_clip
 import os
 import pickle
+import tempfile
+import threading
 import time
-import torch
-import hashlib
-import requests
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from contextlib import ExitStack, contextmanager, nullcontext
 from PIL import Image
-from torchvision import transforms
-from torchvision.transforms.functional import InterpolationMode
-from tqdm import tqdm
-from typing import List
-from .blip import blip_decoder, BLIP_Decoder
+from typing import Iterator, List, TYPE_CHECKING
+from ._lazy import lazy_import
+from .budget import Budget
+from .cache import DiskCache, MemoryCache, image_hash
+from .download import DEFAULT_CHUNK_SIZE, download_file, resolve_source, verify_file
+from .pipeline import MicroBatcher
+from .prompt import PromptBuilder, TokenCounter, truncate_to_fit
+from .quantize import quantize_blip, quantize_clip_text
+from .tracing import stage, traced
+
+# heavy frameworks are only imported once a model is built or a tensor is touched
+np = lazy_import('numpy')
+open_clip = lazy_import('open_clip')
+torch = lazy_import('torch')
+tqdm = lazy_import('tqdm')
+transforms = lazy_import('torchvision.transforms')
+
+if TYPE_CHECKING:
+    from .blip import BLIP_Decoder
+
+BLIP_MODEL_MD5 = 'b78e0b7488c83ba75d58f93f79e885b6'
+
+# set while an async request runs its flavor chain, routes text encoding through the shared micro-batcher
+_text_encoder = contextvars.ContextVar('text_encoder', default=None)
 
 @dataclass 
 class Config:
@@ -27,6 +50,7 @@ class Config:
     blip_image_eval_size: int = 384
     blip_max_length: int = 32
     blip_model_url: str = 'https://storage.googleapis.com/sfr-vision-language-research/BLIP/models/model_large_caption.pth'
+    blip_model_mirror: str = None # base url, directory or file to fetch the checkpoint from instead of blip_model_url
     blip_num_beams: int = 8
     blip_offload: bool = False
 
@@ -38,36 +62,114 @@ class Config:
     cache_path: str = 'cache'
     chunk_size: int = 2048
     data_path: str = os.path.join(os.path.dirname(__file__), 'data')
-    device: str = 'cuda' if torch.cuda.is_available() else 'cpu'
+    download_chunk_size: int = DEFAULT_CHUNK_SIZE
+    device: str = field(default_factory=lambda: 'cuda' if torch.cuda.is_available() else 'cpu')
     flavor_intermediate_count: int = 2048
+    # optional pruning of the flavor chain candidates, see _prune_candidates
+    flavor_prune_count: int = None # candidates kept out of flavor_intermediate_count, None keeps all
+    flavor_prune_diversity: float = 0.3 # 0 keeps the most image-like, higher favours flavors unlike the caption and each other
+    flavor_prune_threshold: float = 0.95 # flavors this similar to the caption or a kept flavor are dropped
     quiet: bool = False # when quiet progress bars are not shown
 
+    # cpu settings
+    quantize: bool = False # dynamic int8 quantization of the BLIP and CLIP text tower Linear layers
+    cpu_bf16: bool = False # bf16 autocast on cpu, only worth it on cpus with native bf16 support
+
+    # captions and image features are reused for images with identical pixels
+    image_cache: object = None # any object with get(key) and set(key, value), see cache.MemoryCache
+    image_cache_path: str = None # directory of a cache.DiskCache used when image_cache is not set
+    image_cache_size: int = 1024 * 1024 * 1024
+
+    # async api, concurrent calls are coalesced into micro-batches
+    batch_max_size: int = 8
+    batch_max_wait: float = 0.005 # seconds a partial batch waits for more requests
+
+    # text features of scored options are kept for options seen again, 0 disables
+    text_cache_size: int = 64 * 1024 * 1024
+
+    # default budget of interrogate, see budget.Budget
+    time_budget: float = None # seconds
+    compute_budget: int = None # candidate prompts encoded
+    budget_batch_size: int = 256 # candidates encoded between budget checks
+
+
+@dataclass
+class PromptStep:
+    stage: str # 'caption', 'check_multi_batch' or 'flavor_chain'
+    prompt: str
+    similarity: float
+    budget: Budget = None # the budget limiting the search, its report is final once iteration ends
+
+
+@dataclass
+class PreparedImage:
+    # an image with its BLIP and CLIP inputs computed ahead, see ClipInterrogator.prepare_image
+    image: Image.Image
+    blip: torch.Tensor = None # [3, blip_image_eval_size, blip_image_eval_size]
+    clip: torch.Tensor = None # clip_preprocess output
+
+
+@dataclass
+class ScoreResult:
+    scores: np.ndarray # [images, labels] cosine similarity of every image with every label
+    labels: List[str]
+
+    def to_dict(self, image: int = 0) -> dict:
+        return dict(zip(self.labels, self.scores[image].tolist()))
+
+    def top(self, count: int = 1, image: int = 0) -> List[str]:
+        return [self.labels[i] for i in np.argsort(-self.scores[image], kind='stable')[:count]]
+
 
 class ClipInterrogator():
     def __init__(self, config: Config):
         self.config = config
         self.device = config.device
+        self.image_cache = config.image_cache
+        if self.image_cache is None and config.image_cache_path is not None:
+            self.image_cache = DiskCache(config.image_cache_path, config.image_cache_size)
+        self.text_cache = MemoryCache(config.text_cache_size) if config.text_cache_size else None
+
+        # request paths only read shared state, these guard the few things built lazily or moved around
+        self._lock = threading.Lock()
+        # one lock per table built on first use, so encoding one blocks nothing else
+        self._table_locks = {'flavors_reduced': threading.Lock(), 'merged': threading.Lock()}
+        self._blip_lock = threading.Lock()
+        self._blip_users = 0
+        self._flavors_reduced = None
+        self.merged = None
+        self._batchers = {}
+        self._chain_executor = None
 
         self.load_blip_model()
         self.load_clip_model()
 
+        # injected models are only known by their weights, not by name or url
+        self._cache_models = {
+            'caption': os.path.basename(config.blip_model_url),
+            'features': config.clip_model_name,
+        }
+        if self.image_cache is not None:
+            if config.blip_model is not None:
+                self._cache_models['caption'] += '@' + _model_fingerprint(self.blip_model)
+            if config.clip_model is not None:
+                self._cache_models['features'] += '@' + _model_fingerprint(self.clip_model)
+
+        if config.quantize:
+            if str(self.device) != 'cpu':
+                raise Exception("quantize is only supported on cpu")
+            self.blip_model = quantize_blip(self.blip_model)
+            self.clip_model = quantize_clip_text(self.clip_model)
+
 
     def load_blip_model(self):
         if self.config.blip_model is None:
             self.cache_model_path = os.path.join(self.config.cache_path, 'model_large_caption.pth')
-            if os.path.exists(self.cache_model_path):
-                model_path = self.cache_model_path
-                with open(self.cache_model_path, 'rb') as f:
-                    model_hash = hashlib.md5(f.read()).hexdigest()
-                    if not model_hash == 'b78e0b7488c83ba75d58f93f79e885b6':
-                        self.download_blip_model()
-                        model_path = self.cache_model_path
-            else:
+            if not verify_file(self.cache_model_path, BLIP_MODEL_MD5, self.config.download_chunk_size):
                 self.download_blip_model()
-#                model_path = self.config.blip_model_url
-                model_path = self.cache_model_path
+            from .blip import blip_decoder
             blip_model = blip_decoder(
-                pretrained=model_path, 
+                pretrained=self.cache_model_path, 
                 image_size=self.config.blip_image_eval_size, 
                 vit='large'
             )
@@ -81,24 +183,20 @@ class ClipInterrogator():
 
 
     def download_blip_model(self):
-        # download new model
-        url = self.config.blip_model_url
-        file_size = int(requests.head(url).headers["content-length"])
-        r = requests.get(url, allow_redirects=True, stream=True)
-        pbar = tqdm(total=file_size, unit="B", unit_scale=True)
-
-        with open(self.cache_model_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                f.write(chunk)
-                pbar.update(len(chunk))
-            pbar.close()
+        # resumes a partial download and only moves it into place once the md5 matches
+        download_file(
+            resolve_source(self.config.blip_model_url, self.config.blip_model_mirror),
+            self.cache_model_path,
+            md5=BLIP_MODEL_MD5,
+            chunk_size=self.config.download_chunk_size,
+            quiet=self.config.quiet
+        )
 
         return
 
     def load_clip_model(self):
+        clip_model_name, clip_model_pretrained_name = self.config.clip_model_name.split('/', 2)
         if self.config.clip_model is None:
-
-            clip_model_name, clip_model_pretrained_name = self.config.clip_model_name.split('/', 2)
             self.clip_model, _, self.clip_preprocess = open_clip.create_model_and_transforms(
                 clip_model_name, 
                 pretrained=clip_model_pretrained_name, 
@@ -112,6 +210,7 @@ class ClipInterrogator():
             self.clip_model = self.config.clip_model
             self.clip_preprocess = self.config.clip_preprocess
         self.tokenize = open_clip.get_tokenizer(clip_model_name)
+        self.token_counter = TokenCounter(self.tokenize)
 
         return
 
@@ -134,63 +233,174 @@ class ClipInterrogator():
         self.mediums = LabelTable(_load_list(self.config.data_path, 'mediums.txt'), "mediums", self.clip_model, self.tokenize, self.config)
         self.movements = LabelTable(_load_list(self.config.data_path, 'movements.txt'), "movements", self.clip_model, self.tokenize, self.config)
         self.trendings = LabelTable(trending_list, "trendings", self.clip_model, self.tokenize, self.config)
+        self.merged = None
+        if self.token_counter.incremental:
+            for table in (self.artists, self.flavors, self.mediums, self.movements, self.trendings):
+                self.token_counter.update(table.labels, table.token_lengths)
 
         return
 
-    def generate_caption(self, pil_image: Image) -> str:
-        if self.config.blip_offload:
-            self.blip_model = self.blip_model.to(self.device)
+    def prepare_image(self, image: Image, blip: bool = True, clip: bool = True) -> PreparedImage:
+        """
+        Runs the BLIP and CLIP preprocessing of an image, so it can happen on
+        decode threads instead of the model thread. Every method taking an
+        image also takes the result, inputs left out are computed when needed.
+        """
+        return PreparedImage(image, self._blip_input(image) if blip else None, self.clip_preprocess(image) if clip else None)
+
+    def _blip_input(self, image) -> torch.Tensor:
+        if isinstance(image, PreparedImage):
+            if image.blip is not None:
+                return image.blip
+            image = image.image
         size = self.config.blip_image_eval_size
-        gpu_image = transforms.Compose([
-            transforms.Resize((size, size), interpolation=InterpolationMode.BICUBIC),
+        transform = transforms.Compose([
+            transforms.Resize((size, size), interpolation=transforms.InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).to(self.device)
-
-        with torch.no_grad():
-            caption = self.blip_model.generate(
-                gpu_image, 
-                sample=False, 
-                num_beams=self.config.blip_num_beams, 
-                max_length=self.config.blip_max_length, 
-                min_length=5
-            )
-        if self.config.blip_offload:
-            self.blip_model = self.blip_model.to("cpu")
-        return caption[0]
+        ])
+        return transform(image)
+
+    def _clip_input(self, image) -> torch.Tensor:
+        if isinstance(image, PreparedImage):
+            if image.clip is not None:
+                return image.clip
+            image = image.image
+        return self.clip_preprocess(image)
+
+    def generate_caption(self, pil_image: Image) -> str:
+        return self.generate_captions([pil_image])[0]
+
+    def generate_captions(self, pil_images: List[Image]) -> List[str]:
+        captions = [None] * len(pil_images)
+        cache_keys = [self._image_cache_key('caption', image) for image in pil_images]
+        for i, cache_key in enumerate(cache_keys):
+            if cache_key is not None:
+                captions[i] = self.image_cache.get(cache_key)
+        missing = [i for i, caption in enumerate(captions) if caption is None]
+        if not missing:
+            return captions
+        with stage('caption', images=len(missing)):
+            gpu_image = torch.stack([self._blip_input(pil_images[i]) for i in missing]).to(self.device)
+
+            with torch.no_grad(), _autocast(self.config, cuda=False), self._blip_on_device():
+                caption = self.blip_model.generate(
+                    gpu_image, 
+                    sample=False, 
+                    num_beams=self.config.blip_num_beams, 
+                    max_length=self.config.blip_max_length, 
+                    min_length=5
+                )
+        for i, text in zip(missing, caption):
+            captions[i] = text
+            if cache_keys[i] is not None:
+                self.image_cache.set(cache_keys[i], text)
+        return captions
+
+    @contextmanager
+    def _blip_on_device(self):
+        # with blip_offload the model stays on the device while any thread is
+        # captioning and only goes back to cpu once the last one is done
+        if not self.config.blip_offload:
+            yield
+            return
+        with self._blip_lock:
+            if self._blip_users == 0:
+                self.blip_model.to(self.device)
+            self._blip_users += 1
+        try:
+            yield
+        finally:
+            with self._blip_lock:
+                self._blip_users -= 1
+                if self._blip_users == 0:
+                    self.blip_model.to("cpu")
 
     def image_to_features(self, image: Image) -> torch.Tensor:
+        return self.images_to_features([image])
+
+    def images_to_features(self, images: List[Image]) -> torch.Tensor:
         try:
-            images = self.clip_preprocess(image).unsqueeze(0).to(self.device)
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                image_features = self.clip_model.encode_image(images)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-            return image_features
+            features = [None] * len(images)
+            cache_keys = [self._image_cache_key('features', image) for image in images]
+            for i, cache_key in enumerate(cache_keys):
+                if cache_key is not None:
+                    features[i] = self.image_cache.get(cache_key)
+            missing = [i for i, f in enumerate(features) if f is None]
+
+            if missing:
+                with stage('image_features', images=len(missing)):
+                    batch = torch.stack([self._clip_input(images[i]) for i in missing]).to(self.device)
+                    with torch.no_grad(), _autocast(self.config):
+                        image_features = self.clip_model.encode_image(batch)
+                        image_features /= image_features.norm(dim=-1, keepdim=True)
+                for row, i in enumerate(missing):
+                    features[i] = image_features[row:row+1]
+                    if cache_keys[i] is not None:
+                        self.image_cache.set(cache_keys[i], features[i].cpu().clone())
+
+            return torch.cat([f.to(self.device) for f in features])
         except Exception as e:
             raise e
 
-    def interragate_score_list(self, image: Image, options: list = None) -> str:
+    def _image_cache_key(self, kind: str, image: Image) -> str:
+        if self.image_cache is None:
+            return None
+        precision = f"{self.config.device}-{'int8' if self.config.quantize else ''}-{'bf16' if self.config.cpu_bf16 else ''}"
+        model = self._cache_models[kind]
+        settings = ''
+        if kind == 'caption':
+            settings = f"{self.config.blip_image_eval_size}-{self.config.blip_num_beams}-{self.config.blip_max_length}"
+        if isinstance(image, PreparedImage):
+            image = image.image
+        return f"{kind}:{model}:{precision}:{settings}:{image_hash(image)}"
+
+    @traced('interragate_score_list')
+    def interragate_score_list(self, image: Image, options: list = None) -> dict:
         try:
-            image_features = self.image_to_features(image)
-            if options:
-                result = {}
-                with torch.no_grad(), torch.cuda.amp.autocast():
-                    for option in options:
-                        text_tokens = self.tokenize([option]).to(self.device)
-                        text_features = self.clip_model.encode_text(text_tokens)
-                        text_features /= text_features.norm(dim=-1, keepdim=True)
-                        similarity = text_features @ image_features.T
-                        result[option] = similarity[0][0].item()
-            else:
+            if not options:
                 raise Exception("No options provided")
+            result = self.score(image, options).to_dict()
             torch.cuda.empty_cache()
             return result
         except Exception as e:
             torch.cuda.empty_cache()
             raise e
 
-
-
+    @traced('score')
+    def score(self, images, options: List[str]) -> ScoreResult:
+        """
+        Similarity of every image with every option as one matrix.
+
+        Args:
+            images: a PIL image, a list of them, or features from images_to_features
+            options (list): texts to score, repeated ones are encoded once
+        """
+        if not options:
+            raise Exception("No options provided")
+        if isinstance(images, Image.Image):
+            images = [images]
+        image_features = images if torch.is_tensor(images) else self.images_to_features(images)
+        text_features = self.text_features(options)
+        with torch.no_grad(), _autocast(self.config):
+            scores = image_features @ text_features.T
+        return ScoreResult(scores.float().cpu().numpy(), list(options))
+
+    def text_features(self, texts: List[str]) -> torch.Tensor:
+        # normalized features per text, unique texts missing from text_cache are encoded in chunk_size batches
+        features = {}
+        for text in dict.fromkeys(texts):
+            features[text] = self.text_cache.get(text) if self.text_cache is not None else None
+        missing = [text for text, f in features.items() if f is None]
+        if missing:
+            for text, f in zip(missing, self._encode_texts(missing)):
+                features[text] = f
+                if self.text_cache is not None:
+                    self.text_cache.set(text, f.clone())
+        return torch.stack([features[text] for text in texts])
+
+
+    @traced('interragate_score')
     def interragate_score(self, image: Image, text: str) -> str:
         try:
             image_features = self.image_to_features(image)
@@ -202,6 +412,7 @@ class ClipInterrogator():
             torch.cuda.empty_cache()
             raise e
 
+    @traced('interrogate_one')
     def interrogate_one(self, image: Image, path: str = None, options: list = None) -> str:
         try:
             image_features = self.image_to_features(image)
@@ -209,37 +420,38 @@ class ClipInterrogator():
                 seed = _load_list(os.path.dirname(path), os.path.basename(path))
                 seed_labels = LabelTable(seed, os.path.basename(path), self.clip_model, self.tokenize, self.config)
             elif options:
-                seed_labels = LabelTable(options, "list", self.clip_model, self.tokenize, self.config)
+                seed_labels = LabelTable(options, None, self.clip_model, self.tokenize, self.config)
             else:
                 raise Exception("No seed or list provided.")
             top = seed_labels.rank(image_features, 1)[0]
             torch.cuda.empty_cache()
-            return _truncate_to_fit(top, self.tokenize)
+            return truncate_to_fit(top, self.token_counter)
         except Exception as e:
             torch.cuda.empty_cache()
             raise e
 
-    def interrogate_flavors(self, image: Image, path: str = None, options: list = None, max_flavors: int = 32) -> str:
+    @traced('interrogate_flavors')
+    def interrogate_flavors(self, image: Image, path: str = None, options: list = None, max_flavors: int = 32, image_features: torch.Tensor = None) -> str:
         try:
-            image_features = self.image_to_features(image)
+            if image_features is None:
+                image_features = self.image_to_features(image)
             if path:
                 seed_labels = _load_list(os.path.dirname(path), os.path.basename(path))
-                self.flavors_reduced = LabelTable(seed_labels, os.path.basename(path), self.clip_model, self.tokenize, self.config)
+                flavors_reduced = LabelTable(seed_labels, os.path.basename(path), self.clip_model, self.tokenize, self.config)
             elif options:
-                self.flavors_reduced = LabelTable(options, "list", self.clip_model, self.tokenize, self.config)
+                flavors_reduced = LabelTable(options, None, self.clip_model, self.tokenize, self.config)
             else:
-                seed_labels = _load_list(os.path.join(self.config.data_path, 'flavors_reduced.txt'))
-                self.flavors_reduced = LabelTable(seed_labels, "flavors_reduced", self.clip_model, self.tokenize, self.config)
-            tops = self.flavors_reduced.rank(image_features, max_flavors)
+                flavors_reduced = self._flavors_reduced_table()
+            tops = flavors_reduced.rank(image_features, max_flavors)
             torch.cuda.empty_cache()
             return ", ".join(tops)
         except Exception as e:
             torch.cuda.empty_cache()
             raise e
 
-    def interrogate_classic(self, image: Image, max_flavors: int=3) -> str:
-        caption = self.generate_caption(image)
-        image_features = self.image_to_features(image)
+    @traced('interrogate_classic')
+    def interrogate_classic(self, image: Image, max_flavors: int=3, caption: str = None, image_features: torch.Tensor = None) -> str:
+        caption, image_features = self._caption_and_features(image, caption, image_features)
 
         medium = self.mediums.rank(image_features, 1)[0]
         artist = self.artists.rank(image_features, 1)[0]
@@ -252,37 +464,57 @@ class ClipInterrogator():
         else:
             prompt = f"{caption}, {medium} {artist}, {trending}, {movement}, {flaves}"
 
-        return _truncate_to_fit(prompt, self.tokenize)
+        return truncate_to_fit(prompt, self.token_counter)
 
-    def interrogate_fast(self, image: Image, max_flavors: int = 32) -> str:
-        caption = self.generate_caption(image)
-        image_features = self.image_to_features(image)
-        merged = _merge_tables([self.artists, self.flavors, self.mediums, self.movements, self.trendings], self.config)
-        tops = merged.rank(image_features, max_flavors)
+    @traced('interrogate_fast')
+    def interrogate_fast(self, image: Image, max_flavors: int = 32, caption: str = None, image_features: torch.Tensor = None) -> str:
+        caption, image_features = self._caption_and_features(image, caption, image_features)
+        tops = self._merged_table().rank(image_features, max_flavors)
         torch.cuda.empty_cache()
-        return _truncate_to_fit(caption + ", " + ", ".join(tops), self.tokenize)
+        return truncate_to_fit(caption + ", " + ", ".join(tops), self.token_counter)
+
+
+    @traced('interrogate')
+    def interrogate(self, image: Image, max_flavors: int=32, caption: str = None, image_features: torch.Tensor = None, budget: Budget = None) -> str:
+        best_prompt = None
+        for step in self.interrogate_iter(image, max_flavors, caption, image_features, budget):
+            best_prompt = step.prompt
+        return best_prompt
 
+    def interrogate_iter(self, image: Image, max_flavors: int=32, caption: str = None, image_features: torch.Tensor = None, budget: Budget = None) -> Iterator[PromptStep]:
+        """
+        The best mode step by step: yields the caption, the prompt after adding the
+        best medium, artist, trending and movement, then every prompt the flavor
+        chain improves on. The last step is what `interrogate` returns. Stop
+        iterating to cancel, no further work is done. Steps carry the budget,
+        also one made from the config budgets, so its report can be read.
+        """
+        if budget is None and (self.config.time_budget is not None or self.config.compute_budget is not None):
+            budget = Budget(self.config.time_budget, self.config.compute_budget)
+        if caption is None:
+            caption = self.generate_caption(image)
+        if image_features is None:
+            image_features = self.image_to_features(image)
 
-    def interrogate(self, image: Image, max_flavors: int=32) -> str:
-        caption = self.generate_caption(image)
-        image_features = self.image_to_features(image)
+        best_prompt = caption
+        best_sim = self.similarity(image_features, best_prompt)
+        with _suspended(budget):
+            yield PromptStep('caption', best_prompt, best_sim, budget)
 
-        flaves = self.flavors.rank(image_features, self.config.flavor_intermediate_count)
+        flave_indices = self.flavors.rank_indices(image_features, self.config.flavor_intermediate_count)
         best_medium = self.mediums.rank(image_features, 1)[0]
         best_artist = self.artists.rank(image_features, 1)[0]
         best_trending = self.trendings.rank(image_features, 1)[0]
         best_movement = self.movements.rank(image_features, 1)[0]
-
-        best_prompt = caption
-        best_sim = self.similarity(image_features, best_prompt)
+        builder = None
 
         def check(addition: str) -> bool:
-            nonlocal best_prompt, best_sim
-            prompt = best_prompt + ", " + addition
-            sim = self.similarity(image_features, prompt)
+            nonlocal best_prompt, best_sim, builder
+            prompt = builder.extended(addition)
+            sim = self.similarity(image_features, prompt.text)
             if sim > best_sim:
                 best_sim = sim
-                best_prompt = prompt
+                best_prompt, builder = prompt.text, prompt
                 return True
             return False
 
@@ -296,116 +528,401 @@ class ClipInterrogator():
                         prompt += ", " + opts[bit]
                 prompts.append(prompt)
 
+            # all 16 combinations are one micro-batch
+            if budget is not None:
+                if budget.exhausted:
+                    budget.stop()
+                    return
+                budget.charge(len(prompts))
             t = LabelTable(prompts, None, self.clip_model, self.tokenize, self.config)
             best_prompt = t.rank(image_features, 1)[0]
             best_sim = self.similarity(image_features, best_prompt)
 
+        if budget is not None:
+            budget.stage = 'check_multi_batch'
         check_multi_batch([best_medium, best_artist, best_trending, best_movement])
-
-        extended_flavors = set(flaves)
-        for _ in tqdm(range(max_flavors), desc="Flavor chain", disable=self.config.quiet):
-            best = self.rank_top(image_features, [f"{best_prompt}, {f}" for f in extended_flavors])
-            flave = best[len(best_prompt)+2:]
-            if not check(flave):
-                break
-            if _prompt_at_max_len(best_prompt, self.tokenize):
-                break
-            extended_flavors.remove(flave)
+        with _suspended(budget):
+            yield PromptStep('check_multi_batch', best_prompt, best_sim, budget)
+        # token count of the prompt is tracked from here on, flavors are counted when their table is built
+        builder = PromptBuilder(self.token_counter, best_prompt)
+
+        if self.config.flavor_prune_count is not None:
+            flave_indices = self._prune_flavors(image_features, caption, flave_indices)
+
+        # label -> row in the flavor table, candidates are tokenized from its stored ids
+        extended_flavors = {self.flavors.labels[i]: i for i in flave_indices}
+        if budget is not None:
+            budget.stage = 'flavor_chain'
+            budget.progress.update(flavors=0, max_flavors=max_flavors)
+        with stage('flavor_chain') as s:
+            for _ in tqdm.tqdm(range(max_flavors), desc="Flavor chain", disable=self.config.quiet):
+                if not extended_flavors:
+                    break # a pruned candidate list can run out before max_flavors
+                s.count(iterations=1)
+                candidates = list(extended_flavors)
+                text_tokens = self.flavors.label_tokens(list(extended_flavors.values()), prefix=best_prompt)
+                best = self.rank_top(image_features, [f"{best_prompt}, {f}" for f in candidates], text_tokens, budget)
+                if best is None:
+                    break
+                flave = best[len(best_prompt)+2:]
+                if not check(flave):
+                    break
+                if budget is not None:
+                    budget.progress['flavors'] += 1
+                with _suspended(budget, s):
+                    yield PromptStep('flavor_chain', best_prompt, best_sim, budget)
+                if builder.at_max_len:
+                    break
+                del extended_flavors[flave]
 
         torch.cuda.empty_cache()
-        return best_prompt
 
-    def rank_top(self, image_features: torch.Tensor, text_array: List[str]) -> str:
-        text_tokens = self.tokenize([text for text in text_array]).to(self.device)
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
+    def _prune_flavors(self, image_features: torch.Tensor, caption: str, flave_indices: List[int]) -> List[int]:
+        with stage('flavor_prune', candidates=len(flave_indices)) as s:
+            embeds = torch.from_numpy(np.asarray(self.flavors.embeds[flave_indices])).to(self.device).float()
+            kept = _prune_candidates(
+                image_features.float(), self.text_features([caption]).float(), embeds,
+                self.config.flavor_prune_count, self.config.flavor_prune_diversity, self.config.flavor_prune_threshold,
+            )
+            s.count(kept=len(kept))
+        return [flave_indices[i] for i in kept]
+
+    def _flavors_reduced_table(self) -> LabelTable:
+        # read without a lock once built, only threads that need the table wait for its encode
+        if self._flavors_reduced is None:
+            with self._table_locks['flavors_reduced']:
+                if self._flavors_reduced is None:
+                    seed_labels = _load_list(self.config.data_path, 'flavors_reduced.txt')
+                    self._flavors_reduced = LabelTable(seed_labels, "flavors_reduced", self.clip_model, self.tokenize, self.config)
+        return self._flavors_reduced
+
+    def _merged_table(self) -> LabelTable:
+        if self.merged is None:
+            with self._table_locks['merged']:
+                if self.merged is None:
+                    self.merged = _merge_tables([self.artists, self.flavors, self.mediums, self.movements, self.trendings], self.config)
+        return self.merged
+
+    def _caption_and_features(self, image: Image, caption: str = None, image_features: torch.Tensor = None):
+        # batch callers compute captions and features for many images up front
+        if caption is None:
+            caption = self.generate_caption(image)
+        if image_features is None:
+            image_features = self.image_to_features(image)
+        return caption, image_features
+
+    def rank_top(self, image_features: torch.Tensor, text_array: List[str], text_tokens: torch.Tensor = None, budget: Budget = None) -> str:
+        if budget is None:
+            text_features = self._encode_texts(text_array, text_tokens)
+        else:
+            # checked between micro-batches, the best of the candidates encoded so far
+            # wins once the budget runs out, None if there was no budget left at all
+            features = []
+            for start in range(0, len(text_array), self.config.budget_batch_size):
+                if budget.exhausted:
+                    budget.stop()
+                    break
+                stop = start + self.config.budget_batch_size
+                features.append(self._encode_texts(text_array[start:stop], None if text_tokens is None else text_tokens[start:stop]))
+                budget.charge(len(features[-1]))
+            if not features:
+                return None
+            text_features = torch.cat(features)
+        with torch.no_grad(), _autocast(self.config):
             similarity = text_features @ image_features.T
         return text_array[similarity.argmax().item()]
 
     def similarity(self, image_features: torch.Tensor, text: str) -> float:
-        text_tokens = self.tokenize([text]).to(self.device)
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
+        text_features = self._encode_texts([text])
+        with torch.no_grad(), _autocast(self.config):
             similarity = text_features @ image_features.T
         return similarity[0][0].item()
 
+    def encode_texts(self, texts: List[str], text_tokens: torch.Tensor = None) -> torch.Tensor:
+        # text_tokens, when given, are the already tokenized texts, see LabelTable.label_tokens
+        features = []
+        with stage('encode_text', strings=len(texts)) as s:
+            for start in range(0, len(texts), self.config.chunk_size):
+                if text_tokens is None:
+                    chunk_tokens = self.tokenize(texts[start:start+self.config.chunk_size])
+                else:
+                    chunk_tokens = text_tokens[start:start+self.config.chunk_size]
+                if s:
+                    s.count(tokens=int((chunk_tokens != 0).sum()))
+                with torch.no_grad(), _autocast(self.config):
+                    text_features = self.clip_model.encode_text(chunk_tokens.to(self.device))
+                    text_features /= text_features.norm(dim=-1, keepdim=True)
+                features.append(text_features)
+        return torch.cat(features)
+
+    def _encode_texts(self, texts: List[str], text_tokens: torch.Tensor = None) -> torch.Tensor:
+        encoder = _text_encoder.get()
+        return self.encode_texts(texts, text_tokens) if encoder is None else encoder(texts, text_tokens)
+
+    async def agenerate_caption(self, image: Image) -> str:
+        return await self._batcher('caption', self.generate_captions).submit(image)
+
+    async def aimage_to_features(self, image: Image) -> torch.Tensor:
+        return await self._batcher('features', lambda images: list(self.images_to_features(images).split(1))).submit(image)
+
+    async def ainterrogate(self, image: Image, max_flavors: int = 32) -> str:
+        return await self._arun(self.interrogate, image, max_flavors=max_flavors)
+
+    async def ainterrogate_classic(self, image: Image, max_flavors: int = 3) -> str:
+        return await self._arun(self.interrogate_classic, image, max_flavors=max_flavors)
+
+    async def ainterrogate_fast(self, image: Image, max_flavors: int = 32) -> str:
+        return await self._arun(self.interrogate_fast, image, max_flavors=max_flavors)
+
+    async def ainterrogate_flavors(self, image: Image, max_flavors: int = 32) -> str:
+        image_features = await self.aimage_to_features(image)
+        return await self._arun(self.interrogate_flavors, image, max_flavors=max_flavors, image_features=image_features)
+
+    async def _arun(self, method, image: Image, **kwargs) -> str:
+        # vision models run on the shared caption and feature batches, the rest
+        # of the request on a worker thread whose text encoding is batched too
+        if 'image_features' not in kwargs:
+            kwargs['caption'], kwargs['image_features'] = await asyncio.gather(self.agenerate_caption(image), self.aimage_to_features(image))
+
+        loop = asyncio.get_running_loop()
+        texts = self._batcher('text', self._encode_text_batches)
+        def encode(text_array: List[str], text_tokens: torch.Tensor = None) -> torch.Tensor:
+            return asyncio.run_coroutine_threadsafe(texts.submit((text_array, text_tokens)), loop).result()
+        context = contextvars.copy_context()
+        context.run(_text_encoder.set, encode)
+        return await loop.run_in_executor(self._chain_pool(), context.run, partial(method, image, **kwargs))
+
+    def _encode_text_batches(self, batches: List[tuple]) -> List[torch.Tensor]:
+        # (texts, text_tokens or None) per request
+        texts = [text for batch, _ in batches for text in batch]
+        text_tokens = torch.cat([self.tokenize(batch) if tokens is None else tokens for batch, tokens in batches])
+        features = self.encode_texts(texts, text_tokens)
+        return list(features.split([len(batch) for batch, _ in batches]))
+
+    def _batcher(self, kind: str, fn) -> MicroBatcher:
+        with self._lock:
+            if kind not in self._batchers:
+                # one thread per batcher, a batch runs while the next one fills
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"clip-interrogator-{kind}")
+                self._batchers[kind] = MicroBatcher(fn, self.config.batch_max_size, self.config.batch_max_wait, executor)
+            return self._batchers[kind]
+
+    def close(self):
+        """
+        Shuts down the threads of the async api once their work is done. Call
+        it from outside the event loop, the interrogator can be used again after.
+        """
+        with self._lock:
+            batchers, self._batchers = self._batchers, {}
+            chain_executor, self._chain_executor = self._chain_executor, None
+        # chains first, they wait on the text batches
+        if chain_executor is not None:
+            chain_executor.shutdown()
+        for batcher in batchers.values():
+            batcher.executor.shutdown()
+
+    def _chain_pool(self) -> ThreadPoolExecutor:
+        # flavor chains block on text batches, enough threads to fill a few of them
+        with self._lock:
+            if self._chain_executor is None:
+                self._chain_executor = ThreadPoolExecutor(max_workers=4 * self.config.batch_max_size, thread_name_prefix="clip-interrogator-chain")
+            return self._chain_executor
+
 
 class LabelTable():
     def __init__(self, labels:List[str], desc:str, clip_model, tokenize, config: Config):
         self.chunk_size = config.chunk_size
         self.config = config
+        self.counter = TokenCounter(tokenize)
+        self.desc = desc
         self.device = config.device
         self.embeds = []
         self.labels = labels
+        self.token_lengths = None # CLIP tokens per label, without start and end tokens
+        self.tokens = None # BPE ids per label, see TokenCounter.split
         self.tokenize = tokenize
 
         hash = hashlib.sha256(",".join(labels).encode()).hexdigest()
+        # cpu ranks in fp32, so that is what gets stored and mapped there
+        dtype = np.float32 if str(self.device) == 'cpu' else np.float16
 
         cache_filepath = None
         if config.cache_path is not None and desc is not None:
-            os.makedirs(config.cache_path, exist_ok=True)
-            sanitized_name = config.clip_model_name.replace('/', '_').replace('@', '_')
-            cache_filepath = os.path.join(config.cache_path, f"{sanitized_name}_{desc}.pkl")
-            if desc is not None and os.path.exists(cache_filepath):
+            cache_filepath = _cache_filepath(config, desc)
+            if os.path.exists(cache_filepath):
                 with open(cache_filepath, 'rb') as f:
                     data = pickle.load(f)
-                    if data.get('hash') == hash:
-                        self.labels = data['labels']
-                        self.embeds = data['embeds']
+                if data.get('hash') == hash:
+                    self.labels = data['labels']
+                    self.token_lengths = data.get('token_lengths')
+                    if self.token_lengths is not None and os.path.exists(_tokens_filepath(cache_filepath)):
+                        self.tokens = _load_array(_tokens_filepath(cache_filepath), 'r')
+                    if os.path.exists(_embeds_filepath(cache_filepath, dtype)):
+                        self.embeds = _load_array(_embeds_filepath(cache_filepath, dtype))
+                    elif 'embeds' in data:
+                        # cache written before embeddings moved to .npy files
+                        self.embeds = np.stack(data['embeds']).astype(dtype)
+                        _save_array(_embeds_filepath(cache_filepath, dtype), self.embeds)
 
         if len(self.labels) != len(self.embeds):
-            self.embeds = []
-            chunks = np.array_split(self.labels, max(1, len(self.labels)/config.chunk_size))
-            for chunk in tqdm(chunks, desc=f"Preprocessing {desc}" if desc else None, disable=self.config.quiet):
-                text_tokens = self.tokenize(chunk).to(self.device)
-                with torch.no_grad(), torch.cuda.amp.autocast():
-                    text_features = clip_model.encode_text(text_tokens)
-                    text_features /= text_features.norm(dim=-1, keepdim=True)
-                    text_features = text_features.half().cpu().numpy()
-                for i in range(text_features.shape[0]):
-                    self.embeds.append(text_features[i])
+            # stored tokens skip BPE when only the embeddings are missing,
+            # e.g. the first run on another device or precision
+            stored_tokens = self.tokens is not None
+            embeds, tokens, lengths = [], [], []
+            with stage(_table_stage('label_table_build', desc), strings=len(self.labels)) as s:
+                for start, stop in tqdm.tqdm(_chunks(len(self.labels), config.chunk_size), desc=f"Preprocessing {desc}" if desc else None, disable=self.config.quiet):
+                    if stored_tokens:
+                        text_tokens = torch.from_numpy(self.counter.assemble(self.tokens[start:stop], self.token_lengths[start:stop]))
+                    else:
+                        text_tokens = self._tokenize(self.labels[start:stop], tokens, lengths)
+                    if s:
+                        s.count(tokens=int((text_tokens != 0).sum()))
+                    with torch.no_grad(), _autocast(self.config):
+                        text_features = clip_model.encode_text(text_tokens.to(self.device))
+                        text_features /= text_features.norm(dim=-1, keepdim=True)
+                        text_features = text_features.half().cpu().numpy()
+                    embeds.append(text_features)
+            self.embeds = np.concatenate(embeds).astype(dtype)
+            if not stored_tokens:
+                self._set_tokens(tokens, lengths)
 
             if cache_filepath is not None:
-                with open(cache_filepath, 'wb') as f:
-                    pickle.dump({
-                        "labels": self.labels, 
-                        "embeds": self.embeds, 
-                        "hash": hash, 
-                        "model": config.clip_model_name
-                    }, f)
-
-        if self.device == 'cpu' or self.device == torch.device('cpu'):
-            self.embeds = [e.astype(np.float32) for e in self.embeds]
-    
+                _save_array(_embeds_filepath(cache_filepath, dtype), self.embeds)
+                if not stored_tokens:
+                    self._save_tokens(cache_filepath, hash)
+                # drop the private copy in favour of the mapping every other process shares
+                self.embeds = _load_array(_embeds_filepath(cache_filepath, dtype))
+        elif cache_filepath is not None and (self.token_lengths is None or (self.tokens is None and self.counter.incremental)):
+            # cache written before token lengths and ids were stored with it
+            tokens, lengths = [], []
+            for start, stop in _chunks(len(self.labels), config.chunk_size):
+                self._tokenize(self.labels[start:stop], tokens, lengths)
+            self._set_tokens(tokens, lengths)
+            self._save_tokens(cache_filepath, hash)
+
+    def label_tokens(self, indices: List[int], prefix: str = None):
+        """
+        Tokenizer output for the labels at `indices`, or for `prefix + ", " + label`,
+        assembled from the stored token ids. None when the table has no ids,
+        which is the case for tokenizers other than open_clip's.
+        """
+        if self.tokens is None:
+            return None
+        indices = np.asarray(indices, dtype=np.int64)
+        labels = [self.labels[i] for i in indices] if prefix is not None else None
+        return torch.from_numpy(self.counter.assemble(self.tokens[indices], self.token_lengths[indices], prefix, labels))
+
+    def _tokenize(self, labels: List[str], tokens: list, lengths: list):
+        text_tokens = self.tokenize(labels)
+        if self.counter.incremental:
+            ids, counts = self.counter.split(text_tokens)
+            tokens.append(ids)
+            lengths.append(counts)
+        else:
+            lengths.append(_token_lengths(text_tokens))
+        return text_tokens
+
+    def _set_tokens(self, tokens: list, lengths: list):
+        self.token_lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int16)
+        if self.counter.incremental:
+            self.tokens = np.concatenate(tokens) if tokens else np.zeros((0, self.counter.max_tokens), dtype=np.uint16)
+
+    def _save_tokens(self, cache_filepath: str, hash: str):
+        if self.tokens is not None:
+            _save_array(_tokens_filepath(cache_filepath), self.tokens)
+            self.tokens = _load_array(_tokens_filepath(cache_filepath), 'r')
+        _save_table_meta(cache_filepath, self.labels, hash, self.token_lengths, self.config)
+
     def _rank(self, image_features: torch.Tensor, text_embeds: torch.Tensor, top_count: int=1) -> str:
         top_count = min(top_count, len(text_embeds))
-        text_embeds = torch.stack([torch.from_numpy(t) for t in text_embeds]).to(self.device)
-        with torch.cuda.amp.autocast():
+        if isinstance(text_embeds, list):
+            text_embeds = np.stack(text_embeds)
+        text_embeds = torch.from_numpy(text_embeds).to(self.device)
+        if text_embeds.dtype == torch.float16 and not str(self.device).startswith('cuda'):
+            # float16 rows, e.g. of an index.ImageIndex, rank in fp32 off cuda
+            text_embeds = text_embeds.float()
+        with _autocast(self.config):
             similarity = image_features @ text_embeds.T
         _, top_labels = similarity.float().cpu().topk(top_count, dim=-1)
         return [top_labels[0][i].numpy() for i in range(top_count)]
 
     def rank(self, image_features: torch.Tensor, top_count: int=1) -> List[str]:
-        if len(self.labels) <= self.chunk_size:
-            tops = self._rank(image_features, self.embeds, top_count=top_count)
-            return [self.labels[i] for i in tops]
-
-        num_chunks = int(math.ceil(len(self.labels)/self.chunk_size))
-        keep_per_chunk = int(self.chunk_size / num_chunks)
-
-        top_labels, top_embeds = [], []
-        for chunk_idx in tqdm(range(num_chunks), disable=self.config.quiet):
-            start = chunk_idx*self.chunk_size
-            stop = min(start+self.chunk_size, len(self.embeds))
-            tops = self._rank(image_features, self.embeds[start:stop], top_count=keep_per_chunk)
-            top_labels.extend([self.labels[start+i] for i in tops])
-            top_embeds.extend([self.embeds[start+i] for i in tops])
-
-        tops = self._rank(image_features, top_embeds, top_count=top_count)
-        return [top_labels[i] for i in tops]
-
+        return [self.labels[i] for i in self.rank_indices(image_features, top_count)]
+
+    def rank_indices(self, image_features: torch.Tensor, top_count: int=1) -> List[int]:
+        with stage(_table_stage('rank', self.desc), labels=len(self.labels)):
+            if len(self.labels) <= self.chunk_size:
+                return [int(i) for i in self._rank(image_features, self.embeds, top_count=top_count)]
+
+            num_chunks = int(math.ceil(len(self.labels)/self.chunk_size))
+            keep_per_chunk = max(1, int(self.chunk_size / num_chunks))
+
+            top_indices, top_embeds = [], []
+            for chunk_idx in tqdm.tqdm(range(num_chunks), disable=self.config.quiet):
+                start = chunk_idx*self.chunk_size
+                stop = min(start+self.chunk_size, len(self.embeds))
+                tops = self._rank(image_features, self.embeds[start:stop], top_count=keep_per_chunk)
+                top_indices.extend([start+int(i) for i in tops])
+                top_embeds.extend([self.embeds[start+i] for i in tops])
+
+            tops = self._rank(image_features, top_embeds, top_count=top_count)
+            return [top_indices[i] for i in tops]
+
+
+def _autocast(config: Config, cuda: bool = True):
+    # fp16 autocast on cuda, opt-in bf16 autocast on cpu, full precision otherwise
+    if str(config.device).startswith('cuda'):
+        return torch.autocast('cuda') if cuda else nullcontext()
+    if config.cpu_bf16 and str(config.device) == 'cpu':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return nullcontext()
+
+def _prune_candidates(image_features: torch.Tensor, caption_features: torch.Tensor, embeds: torch.Tensor,
+                      count: int, diversity: float, threshold: float) -> List[int]:
+    # maximal marginal relevance: similarity to the image traded against the
+    # highest similarity to the caption or an already kept candidate, and
+    # near-synonyms of either are never kept. Returns rows of embeds in pick order
+    relevance = (embeds @ image_features.T)[:, 0]
+    redundancy = (embeds @ caption_features.T)[:, 0]
+    available = redundancy < threshold
+    kept = []
+    while len(kept) < count and available.any():
+        score = (1 - diversity) * relevance - diversity * redundancy
+        score[~available] = -math.inf
+        best = int(score.argmax())
+        kept.append(best)
+        similarity = embeds @ embeds[best]
+        redundancy = torch.maximum(redundancy, similarity)
+        available &= similarity < threshold
+        available[best] = False
+    return kept
+
+@contextmanager
+def _suspended(*clocks):
+    # stops the budget and stage clocks while a caller of interrogate_iter holds a step
+    with ExitStack() as stack:
+        for clock in clocks:
+            if clock is not None:
+                stack.enter_context(clock.suspended())
+        yield
+
+
+def _model_fingerprint(model) -> str:
+    # names, shapes and a strided sample of every weight, cheap even for ViT-L
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        if not torch.is_tensor(tensor):
+            continue
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        flat = tensor.detach().reshape(-1)
+        if len(flat):
+            h.update(flat[::max(1, len(flat) // 16)].float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def _table_stage(name: str, desc: str) -> str:
+    # named tables are traced on their own, 'rank:flavors', 'rank:artists', ...
+    return f"{name}:{desc}" if desc else name
 
 def _load_list(data_path: str, filename: str) -> List[str]:
     with open(os.path.join(data_path, filename), 'r', encoding='utf-8', errors='replace') as f:
@@ -416,18 +933,64 @@ def _merge_tables(tables: List[LabelTable], config: Config) -> LabelTable:
     m = LabelTable([], None, None, None, config)
     for table in tables:
         m.labels.extend(table.labels)
-        m.embeds.extend(table.embeds)
+    m.token_lengths = np.concatenate([table.token_lengths for table in tables])
+    if config.cache_path is None:
+        m.embeds = np.concatenate([table.embeds for table in tables])
+        return m
+
+    # published like any other table so every process maps the same file
+    hash = hashlib.sha256(",".join(m.labels).encode()).hexdigest()
+    dtype = np.float32 if str(config.device) == 'cpu' else np.float16
+    filepath = _embeds_filepath(_cache_filepath(config, f"merged_{hash[:16]}"), dtype)
+    if not os.path.exists(filepath):
+        _save_array(filepath, np.concatenate([table.embeds for table in tables]))
+    m.embeds = _load_array(filepath)
     return m
 
-def _prompt_at_max_len(text: str, tokenize) -> bool:
-    tokens = tokenize([text])
-    return tokens[0][-1] != 0
-
-def _truncate_to_fit(text: str, tokenize) -> str:
-    parts = text.split(', ')
-    new_text = parts[0]
-    for part in parts[1:]:
-        if _prompt_at_max_len(new_text + part, tokenize):
-            break
-        new_text += ', ' + part
-    return new_text
+def _cache_filepath(config: Config, desc: str) -> str:
+    os.makedirs(config.cache_path, exist_ok=True)
+    sanitized_name = config.clip_model_name.replace('/', '_').replace('@', '_')
+    if config.quantize:
+        sanitized_name += '_int8'
+    if config.cpu_bf16 and str(config.device) == 'cpu':
+        sanitized_name += '_bf16'
+    return os.path.join(config.cache_path, f"{sanitized_name}_{desc}.pkl")
+
+def _embeds_filepath(cache_filepath: str, dtype) -> str:
+    return f"{cache_filepath[:-len('.pkl')]}.{np.dtype(dtype).name}.npy"
+
+def _tokens_filepath(cache_filepath: str) -> str:
+    return f"{cache_filepath[:-len('.pkl')]}.tokens.npy"
+
+def _chunks(count: int, chunk_size: int) -> List[tuple]:
+    # (start, stop) of evenly sized chunks of at most about chunk_size
+    bounds = np.linspace(0, count, max(1, int(count / chunk_size)) + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def _save_array(filepath: str, array):
+    # written under a unique temporary name so concurrent workers, processes
+    # or threads, never map a partial file
+    fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_filepath, filepath)
+
+def _load_array(filepath: str, mode: str = 'c'):
+    # copy-on-write mapping: pages come from the shared page cache and are
+    # never written, so N worker processes hold one copy of the table
+    return np.load(filepath, mmap_mode=mode)
+
+def _save_table_meta(cache_filepath: str, labels: List[str], hash: str, token_lengths, config: Config):
+    fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(cache_filepath), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({
+            "labels": labels, 
+            "hash": hash, 
+            "model": config.clip_model_name,
+            "token_lengths": token_lengths,
+        }, f)
+    os.replace(tmp_filepath, cache_filepath)
+
+def _token_lengths(text_tokens: torch.Tensor):
+    # padding is 0, so whatever is left besides the start and end tokens
+    return ((text_tokens != 0).sum(dim=1) - 2).numpy().astype(np.int16)
@@ -0,0 +1,52 @@
+from typing import List
+from ._lazy import lazy_import
+
+torch = lazy_import('torch')
+
+
+class DedupIndex():
+    """
+    Incremental near-duplicate index over normalized CLIP image features.
+    A new image joins the most similar representative whose cosine similarity
+    reaches `threshold`, or becomes a representative itself. Only
+    representatives are stored, one float32 feature row each.
+
+    `values` holds one entry per representative for the caller, None until set.
+    """
+    def __init__(self, threshold: float = 0.95):
+        self.threshold = threshold
+        self.features = None # [capacity, dim], rows past count are unused
+        self.count = 0
+        self.values = []
+
+    def assign(self, features) -> List[int]:
+        # representative id per row, rows of the same batch can match each other
+        features = features.float().cpu()
+        existing = self.count
+        matches = [None] * len(features)
+        if existing:
+            similarity, best = (features @ self.features[:existing].T).max(dim=1)
+            matches = [int(b) if s >= self.threshold else None for s, b in zip(similarity.tolist(), best.tolist())]
+
+        for row, match in enumerate(matches):
+            if match is None and self.count > existing:
+                similarity, best = (self.features[existing:self.count] @ features[row]).max(dim=0)
+                if similarity >= self.threshold:
+                    match = existing + int(best)
+            if match is None:
+                match = self._add(features[row])
+            matches[row] = match
+        return matches
+
+    def _add(self, feature) -> int:
+        if self.features is None:
+            self.features = torch.empty((64, len(feature)), dtype=torch.float32)
+        elif self.count == len(self.features):
+            # doubling keeps appends amortized O(1)
+            grown = torch.empty((2 * len(self.features), self.features.shape[1]), dtype=torch.float32)
+            grown[:self.count] = self.features
+            self.features = grown
+        self.features[self.count] = feature
+        self.values.append(None)
+        self.count += 1
+        return self.count - 1
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from urllib.parse import urlparse
+from ._lazy import lazy_import
+
+requests = lazy_import('requests')
+tqdm = lazy_import('tqdm')
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def resolve_source(url: str, mirror: str = None) -> str:
+    # a mirror can be a local file, a local directory holding the file, or a base url
+    if not mirror:
+        return url
+    filename = os.path.basename(urlparse(url).path)
+    if os.path.isdir(mirror):
+        return os.path.join(mirror, filename)
+    if os.path.isfile(mirror) or not _is_url(mirror):
+        return mirror
+    return mirror.rstrip('/') + '/' + filename
+
+
+def file_md5(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def verify_file(path: str, md5: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+    # the stamp written next to a verified download lets us skip rehashing
+    # multi-GB checkpoints on every start as long as the file is untouched
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    stamp_path = path + '.md5'
+    if os.path.exists(stamp_path):
+        try:
+            with open(stamp_path, 'r') as f:
+                stamp = json.load(f)
+            if stamp == {'md5': md5, 'size': stat.st_size, 'mtime': stat.st_mtime}:
+                return True
+        except (OSError, ValueError):
+            pass
+    if file_md5(path, chunk_size) != md5:
+        return False
+    _write_stamp(path, md5)
+    return True
+
+
+def download_file(url: str, path: str, md5: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  retries: int = 3, quiet: bool = False, session=None) -> str:
+    """
+    Args:
+        url (str): http(s) url or local path of the file to fetch
+        path (str): final destination, only written once the file is complete and verified
+        md5 (str): expected md5 hex digest, computed while streaming
+        chunk_size (int): bytes read per chunk
+        retries (int): number of times an interrupted transfer is resumed
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    part_path = path + '.part'
+
+    if _is_url(url):
+        session = session or requests.Session()
+        for attempt in range(retries + 1):
+            try:
+                digest = _fetch(session, url, part_path, chunk_size, quiet)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == retries:
+                    raise
+    else:
+        digest = _copy(url[len('file://'):] if url.startswith('file://') else url, part_path, chunk_size, quiet)
+
+    if md5 is not None and digest != md5:
+        os.remove(part_path)
+        raise RuntimeError(f"md5 mismatch for {url}: expected {md5}, got {digest}")
+
+    os.replace(part_path, path)
+    if md5 is not None:
+        _write_stamp(path, md5)
+    return path
+
+
+def _fetch(session, url: str, part_path: str, chunk_size: int, quiet: bool) -> str:
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(part_path):
+        # bytes already on disk still have to go through the digest
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+                offset += len(chunk)
+
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, allow_redirects=True) as r:
+        if r.status_code == 416:
+            # nothing left to fetch, the partial file is already complete
+            return md5.hexdigest()
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            # server ignored the range request, start over
+            md5 = hashlib.md5()
+            offset = 0
+
+        total = r.headers.get('content-length')
+        total = int(total) + offset if total is not None else None
+        pbar = tqdm.tqdm(total=total, initial=offset, unit="B", unit_scale=True, disable=quiet)
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                md5.update(chunk)
+                pbar.update(len(chunk))
+        pbar.close()
+    return md5.hexdigest()
+
+
+def _copy(src: str, part_path: str, chunk_size: int, quiet: bool) -> str:
+    md5 = hashlib.md5()
+    pbar = tqdm.tqdm(total=os.path.getsize(src), unit="B", unit_scale=True, disable=quiet)
+    with open(src, 'rb') as fin, open(part_path, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            fout.write(chunk)
+            md5.update(chunk)
+            pbar.update(len(chunk))
+    pbar.close()
+    return md5.hexdigest()
+
+
+def _write_stamp(path: str, md5: str):
+    stat = os.stat(path)
+    with open(path + '.md5', 'w') as f:
+        json.dump({'md5': md5, 'size': stat.st_size, 'mtime': stat.st_mtime}, f)
+
+
+def _is_url(url: str) -> bool:
+    return urlparse(url).scheme in ('http', 'https')
@@ -0,0 +1,113 @@
+import statistics
+import time
+from typing import List
+from . import batch
+
+TABLES = ['artists', 'flavors', 'mediums', 'movements', 'trendings']
+
+# batch modes that build a prompt, caption only runs BLIP
+MODES = {name: method for name, method in batch.MODES.items() if method is not None}
+
+
+def table_recall(reference, candidate, reference_features, candidate_features, top_count: int = 10) -> dict:
+    # share of the reference's top labels per table the candidate also ranks in its top
+    recall = {}
+    for name in TABLES:
+        ref_top = getattr(reference, name).rank(reference_features, top_count)
+        cand_top = getattr(candidate, name).rank(candidate_features, top_count)
+        recall[name] = len(set(ref_top) & set(cand_top)) / max(1, len(ref_top))
+    return recall
+
+
+def evaluate(reference, candidate, images: List, mode: str = 'best', candidate_mode: str = None,
+             top_count: int = 10, max_flavors: int = 32, warmup: bool = True) -> dict:
+    """
+    Runs the reference path and a candidate on the same images and reports how
+    much quality the candidate gives up for its speed.
+
+    Args:
+        reference (ClipInterrogator): exact configuration
+        candidate (ClipInterrogator): configuration to check, can be the same instance with another `candidate_mode`
+        images (list): PIL images, see testing.random_images for synthetic ones
+        mode (str): reference mode, one of MODES
+        candidate_mode (str): candidate mode, defaults to `mode`
+        top_count (int): ranked labels compared per table
+
+    Returns per-table top-k recall, the share of reference prompt terms kept,
+    the reference model's CLIP similarity of both final prompts and its delta,
+    and per-image latency, averaged and per image. Leave the image cache
+    off, cached captions and features would make the latency meaningless.
+    """
+    candidate_mode = candidate_mode or mode
+    for name in (mode, candidate_mode):
+        if name not in MODES:
+            raise Exception(f"Unknown mode {name}, expected one of {', '.join(MODES)}")
+    for ci in (reference, candidate):
+        if not hasattr(ci, 'flavors'):
+            ci.prepare_labels()
+    ref_method = getattr(reference, MODES[mode])
+    cand_method = getattr(candidate, MODES[candidate_mode])
+    if warmup and images:
+        # first calls build merged tables and warm allocators
+        ref_method(images[0], max_flavors=max_flavors)
+        cand_method(images[0], max_flavors=max_flavors)
+
+    rows = []
+    for image in images:
+        ref_prompt, ref_ms = _timed(ref_method, image, max_flavors)
+        cand_prompt, cand_ms = _timed(cand_method, image, max_flavors)
+
+        ref_features = reference.image_to_features(image)
+        cand_features = candidate.image_to_features(image)
+        ref_terms, cand_terms = set(ref_prompt.split(', ')), set(cand_prompt.split(', '))
+        ref_sim = reference.similarity(ref_features, ref_prompt)
+        cand_sim = reference.similarity(ref_features, cand_prompt)
+        rows.append({
+            'reference_prompt': ref_prompt,
+            'candidate_prompt': cand_prompt,
+            'reference_similarity': ref_sim,
+            'candidate_similarity': cand_sim,
+            'similarity_delta': cand_sim - ref_sim,
+            'prompt_recall': len(ref_terms & cand_terms) / max(1, len(ref_terms)),
+            'recall': table_recall(reference, candidate, ref_features, cand_features, top_count),
+            'reference_ms': ref_ms,
+            'candidate_ms': cand_ms,
+        })
+
+    mean = lambda key: statistics.mean(row[key] for row in rows) if rows else 0.0
+    return {
+        'mode': mode,
+        'candidate_mode': candidate_mode,
+        'top_count': top_count,
+        'count': len(rows),
+        'recall': {name: statistics.mean(row['recall'][name] for row in rows) if rows else 0.0 for name in TABLES},
+        'prompt_recall': mean('prompt_recall'),
+        'similarity': {
+            'reference': mean('reference_similarity'),
+            'candidate': mean('candidate_similarity'),
+            'delta': mean('similarity_delta'),
+        },
+        'latency_ms': {
+            'reference': _latency([row['reference_ms'] for row in rows]),
+            'candidate': _latency([row['candidate_ms'] for row in rows]),
+        },
+        'speedup': mean('reference_ms') / mean('candidate_ms') if rows and mean('candidate_ms') > 0 else None,
+        'images': rows,
+    }
+
+
+def _timed(method, image, max_flavors: int):
+    start = time.perf_counter()
+    prompt = method(image, max_flavors=max_flavors)
+    return prompt, (time.perf_counter() - start) * 1000
+
+
+def _latency(times: List[float]) -> dict:
+    if not times:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0}
+    ordered = sorted(times)
+    return {
+        'mean': statistics.mean(ordered),
+        'p50': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+    }
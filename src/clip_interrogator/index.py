@@ -0,0 +1,194 @@
+import json
+import math
+import os
+from contextlib import contextmanager
+from typing import List, Tuple
+from PIL import Image
+from ._lazy import lazy_import
+
+np = lazy_import('numpy')
+torch = lazy_import('torch')
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no lock between processes on windows
+
+FEATURES_FILE = 'features.f16'
+IDS_FILE = 'ids.jsonl'
+META_FILE = 'meta.json'
+LOCK_FILE = 'lock'
+
+
+class ImageIndex():
+    """
+    Appendable on-disk index of normalized CLIP image features, searched by
+    text or by image. Features are float16 rows in a flat file that is
+    memory-mapped for search, so the corpus is paged in from disk instead of
+    held in memory, and ids (usually paths) are one JSON line per row.
+
+        index = ImageIndex('index')
+        index.add(paths, ci.images_to_features(images))
+        index.flush()
+        index.search(ci, "a red car", top_count=10)  # [(path, similarity), ...]
+
+    Rows are only written by `flush`. Rows written without their id, by a
+    process killed in between, are dropped when the index is opened again.
+    Flushes and opens hold an exclusive file lock, so several processes, like
+    the workers of `launch`, can append to one index. Each flush first picks
+    up the ids other processes flushed, so rows and ids stay aligned.
+    """
+    def __init__(self, path: str, model: str = None):
+        self.path = path
+        self.model = model
+        self.dim = None
+        self.ids = []
+        self.pending = [] # (ids, float16 features) waiting for flush
+        self._mapped = None
+        self._ids_offset = 0 # bytes of the ids file read into self.ids
+
+        os.makedirs(path, exist_ok=True)
+        with _locked(path):
+            self._read_meta()
+            self._read_ids()
+            if self.dim is not None:
+                self._truncate()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids: List[str], features):
+        if len(ids) != len(features):
+            raise Exception(f"{len(ids)} ids for {len(features)} feature rows")
+        features = features.float().cpu().numpy() if torch.is_tensor(features) else np.asarray(features)
+        if self.dim is None:
+            self.dim = features.shape[1]
+        elif features.shape[1] != self.dim:
+            raise Exception(f"Index {self.path} holds {self.dim} dimensional features, got {features.shape[1]}")
+        self.pending.append((list(ids), features.astype(np.float16)))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with _locked(self.path):
+            self._read_meta()
+            if self.dim != self.pending[0][1].shape[1]:
+                raise Exception(f"Index {self.path} holds {self.dim} dimensional features, got {self.pending[0][1].shape[1]}")
+            self._write_meta()
+            self._read_ids()
+            # features first, ids second: rows without an id are dropped on open
+            with open(os.path.join(self.path, FEATURES_FILE), 'ab') as f:
+                for _, features in self.pending:
+                    f.write(features.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(os.path.join(self.path, IDS_FILE), 'ab') as f:
+                for ids, _ in self.pending:
+                    for id in ids:
+                        f.write((json.dumps(id, ensure_ascii=False) + '\n').encode('utf-8'))
+                        self.ids.append(id)
+                f.flush()
+                os.fsync(f.fileno())
+                self._ids_offset = f.tell()
+        self.pending = []
+
+    def features(self):
+        # [rows, dim] read-only mapping of everything flushed so far
+        if self._mapped is None or len(self._mapped) != len(self.ids):
+            self._mapped = None
+            if self.ids:
+                self._mapped = np.memmap(os.path.join(self.path, FEATURES_FILE), dtype=np.float16, mode='c', shape=(len(self.ids), self.dim))
+        return self._mapped
+
+    def search(self, ci, query, top_count: int = 10) -> List[Tuple[str, float]]:
+        """
+        Most similar images for a text prompt, a PIL image or a feature tensor,
+        as (id, cosine similarity) pairs, best first.
+        """
+        from .clip_interrogator import LabelTable
+        if not self.ids:
+            return []
+        if isinstance(query, str):
+            query = ci.text_features([query])
+        elif isinstance(query, Image.Image):
+            query = ci.image_to_features(query)
+
+        # a label table over the mapped rows, with chunks large enough that
+        # each keeps at least top_count rows, so no true top row is dropped
+        table = LabelTable([], None, None, None, ci.config)
+        table.desc, table.labels, table.embeds = 'images', self.ids, self.features()
+        table.chunk_size = _exact_chunk_size(len(self.ids), top_count, ci.config.chunk_size)
+        indices = table.rank_indices(query, top_count)
+
+        scores = torch.from_numpy(self.features()[indices].astype(np.float32)) @ query.float().cpu().T
+        return [(self.ids[i], float(score)) for i, score in zip(indices, scores[:, 0].tolist())]
+
+    def _read_meta(self):
+        meta_path = os.path.join(self.path, META_FILE)
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if self.model is not None and meta.get('model') not in (None, self.model):
+            raise Exception(f"Index {self.path} holds {meta['model']} features, not {self.model}")
+        self.model, self.dim = meta.get('model'), meta['dim']
+
+    def _read_ids(self):
+        # ids appended since the last read, by this or another process
+        ids_path = os.path.join(self.path, IDS_FILE)
+        if not os.path.exists(ids_path):
+            return
+        with open(ids_path, 'rb') as f:
+            f.seek(self._ids_offset)
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError
+                    self.ids.append(json.loads(line))
+                except ValueError:
+                    break # torn last line of an interrupted flush
+                self._ids_offset += len(line)
+
+    def _truncate(self):
+        features_path = os.path.join(self.path, FEATURES_FILE)
+        row_bytes = self.dim * 2
+        rows = os.path.getsize(features_path) // row_bytes if os.path.exists(features_path) else 0
+        if rows != len(self.ids):
+            count = min(rows, len(self.ids))
+            self.ids = self.ids[:count]
+            with open(features_path, 'ab') as f:
+                f.truncate(count * row_bytes)
+            with open(os.path.join(self.path, IDS_FILE), 'wb') as f:
+                for id in self.ids:
+                    f.write((json.dumps(id, ensure_ascii=False) + '\n').encode('utf-8'))
+                self._ids_offset = f.tell()
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.path, META_FILE)
+        if not os.path.exists(meta_path):
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'model': self.model, 'dim': self.dim, 'dtype': 'float16'}, f)
+            os.replace(meta_path + '.tmp', meta_path)
+
+
+@contextmanager
+def _locked(path: str):
+    # exclusive across processes, and across instances within one process
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(path, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _exact_chunk_size(rows: int, top_count: int, chunk_size: int) -> int:
+    # LabelTable.rank_indices keeps int(chunk_size / chunks) rows per chunk,
+    # sqrt(rows * top_count) is the starting point, the rounding is fixed up
+    chunk_size = max(chunk_size, math.ceil(math.sqrt(rows * top_count)))
+    while chunk_size < rows and int(chunk_size / math.ceil(rows / chunk_size)) < top_count:
+        chunk_size += top_count
+    return chunk_size
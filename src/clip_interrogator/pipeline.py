@@ -0,0 +1,174 @@
+import asyncio
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+
+def load_image(path, draft_size: int = None) -> Image.Image:
+    # path can also be a file object
+    image = Image.open(path)
+    if draft_size and image.format == 'JPEG':
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale while staying above draft_size
+        image.draft('RGB', (draft_size, draft_size))
+    return image.convert('RGB')
+
+
+def prefetch_images(paths: Iterable[str], workers: int = 4, prefetch: int = 16, draft_size: int = None,
+                    processes: bool = False, loader: Callable = load_image, prepare: Callable = None) -> Iterator[Tuple[str, Image.Image, Exception]]:
+    """
+    Decodes, and optionally preprocesses, images on a worker pool while the
+    caller runs the model on earlier ones. Yields (path, image, error) in input
+    order, at most `prefetch` images are in flight.
+
+    Args:
+        paths (iterable): image files, consumed lazily
+        workers (int): decode threads, or processes when `processes` is set
+        prefetch (int): bound on decoded images waiting for the model
+        draft_size (int): smallest side the model needs, lets JPEGs decode at reduced scale
+        loader (callable): called as loader(path, draft_size) on the pool, must be picklable with `processes`
+        prepare (callable): called with the loader's result on the pool, e.g. ClipInterrogator.prepare_image
+            to run the BLIP and CLIP transforms there too, must be picklable with `processes`
+    """
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    paths = iter(paths)
+    pending = deque()
+    with executor(max_workers=workers) as pool:
+        def submit():
+            for path in paths:
+                pending.append((path, pool.submit(_load, loader, prepare, path, draft_size)))
+                return
+
+        for _ in range(max(1, prefetch)):
+            submit()
+        while pending:
+            path, future = pending.popleft()
+            submit()
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, e
+
+
+def _load(loader: Callable, prepare: Callable, path, draft_size: int):
+    loaded = loader(path, draft_size)
+    return loaded if prepare is None else prepare(loaded)
+
+
+class ResultWriter():
+    """
+    Runs `sink` on a background thread so printing or writing results
+    never holds up the model stage.
+    """
+    def __init__(self, sink: Callable, maxsize: int = 256):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.sink(item)
+                except Exception as e:
+                    self.error = e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MicroBatcher():
+    """
+    Coalesces concurrent `submit` calls into `fn(items)` calls of at most
+    `max_batch_size` items. A partial batch waits at most `max_wait` seconds
+    for more items. `fn` runs on `executor` and returns one result per item.
+    """
+    def __init__(self, fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.005,
+                 executor: Executor = None):
+        self.fn = fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.executor = executor
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    async def submit(self, item) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task.done():
+            # queues and tasks belong to one event loop, start over on a new one
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = loop.create_task(self._run())
+        future = loop.create_future()
+        self.queue.put_nowait((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn, [item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    _settle(batch[0][1], error=e)
+                    continue
+                # one bad item must not fail its batch mates, each is retried alone
+                for item, future in batch:
+                    try:
+                        result = (await loop.run_in_executor(self.executor, self.fn, [item]))[0]
+                    except Exception as e:
+                        _settle(future, error=e)
+                        continue
+                    _settle(future, result)
+                continue
+            for (_, future), result in zip(batch, results):
+                _settle(future, result)
+
+
+def _settle(future, result=None, error: Exception = None):
+    # callers may have given up on their future in the meantime
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
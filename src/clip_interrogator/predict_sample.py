@@ -2,12 +2,15 @@ import os
 import argparse
 from PIL import Image
 from clip_interrogator import ClipInterrogator, Config
+from clip_interrogator.pipeline import ResultWriter, prefetch_images
 
 args = argparse.ArgumentParser()
 
 def parse_args():
     global args
     args.add_argument("--source_dir", type = str, default = ".", required=True)
+    args.add_argument("--workers", type = int, default = 4, help = "image decode threads")
+    args.add_argument("--prefetch", type = int, default = 16, help = "decoded images queued ahead of the model")
     args = args.parse_args()
 
 models = [
@@ -24,6 +27,7 @@ class Interrogator:
             clip_model_name="ViT-H-14/laion2b_s32b_b79k",
             blip_image_eval_size=512,
         ))
+        self.ci.prepare_labels()
 
     def interrogate(self, pil_image: Image):
         prompt = self.ci.interrogate(pil_image)
@@ -40,20 +44,29 @@ def create_source_list(source_dir):
     return source_list
 
 
+def print_result(result):
+    source, prompt = result
+    print("")
+    print(source)
+    print(prompt)
+    print("")
+
+
 def main():
     parse_args()
     interrogator = Interrogator()
     source_list = create_source_list(args.source_dir)
 
-    for source in source_list:
-        image = Image.open(source)
-
-        print("")
-        print(source)
-        prompt = interrogator.interrogate(image)
-
-        print(prompt)
-        print("")
+    # decode and the BLIP and CLIP preprocessing run on the worker pool and printing on the writer thread,
+    # the loop below only ever waits on the model
+    with ResultWriter(print_result) as writer:
+        for source, image, error in prefetch_images(source_list, args.workers, args.prefetch, draft_size=interrogator.base_size,
+                                                    prepare=interrogator.ci.prepare_image):
+            if error is not None:
+                writer.put((source, f"error: {error}"))
+                continue
+            prompt = interrogator.interrogate(image)
+            writer.put((source, prompt))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,202 @@
+import bisect
+import os
+import sys
+import threading
+import time
+import warnings
+from typing import List
+from ._lazy import lazy_import
+from .tracing import Tracer
+
+torch = lazy_import('torch')
+
+
+class MemoryProfiler(Tracer):
+    """
+    Tracer that also records, per stage and per label table, the peak host RSS
+    and the peak of torch's cuda allocator while the stage ran. A background
+    thread samples RSS every `interval` seconds, so spikes shorter than that
+    can be missed. Peaks are only attributed correctly when one request runs
+    at a time.
+
+        with MemoryProfiler() as profiler:
+            ci.interrogate(image)
+        print(profiler.summary())
+
+    Report entries gain peak_rss_bytes and rss_growth_bytes (peak above the
+    RSS at stage start), plus cuda_peak_bytes and cuda_growth_bytes on cuda.
+
+    With `cpu_allocations` torch.profiler records every cpu tensor allocation
+    and entries also gain cpu_alloc_peak_bytes, the peak of tensor memory
+    allocated within the stage and still alive, and cpu_allocated_bytes, all
+    tensor bytes the stage allocated. The profiler slows every torch op down
+    and the numbers are only filled in when the profiler is exited. Torch
+    versions whose profiler memory events can't be read or matched to stage
+    times get a warning instead.
+    """
+    def __init__(self, interval: float = 0.005, cuda: bool = None, cpu_allocations: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = interval
+        self.cuda = cuda
+        self.cpu_allocations = cpu_allocations
+        self.torch_profiler = None
+        self.spans = [] # (name, start ns, end ns) of finished stages, for cpu allocations
+        self.windows = []
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start_stage(self, name: str):
+        rss = current_rss()
+        window = {'rss_start': rss, 'rss_peak': rss}
+        if self.cuda:
+            self._fold_cuda_peak()
+            window['cuda_start'] = window['cuda_peak'] = torch.cuda.memory_allocated()
+        if self.cpu_allocations:
+            window['ns_start'] = time.time_ns()
+        with self.lock:
+            self.windows.append(window)
+        return window
+
+    def end_stage(self, name: str, window):
+        rss = current_rss()
+        if self.cuda:
+            self._fold_cuda_peak()
+        with self.lock:
+            # by identity, nested windows can hold equal numbers
+            self.windows = [w for w in self.windows if w is not window]
+            peak = max(window['rss_peak'], rss)
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            _keep_max(stage, 'peak_rss_bytes', peak)
+            _keep_max(stage, 'rss_growth_bytes', peak - window['rss_start'])
+            if self.cuda:
+                _keep_max(stage, 'cuda_peak_bytes', window['cuda_peak'])
+                _keep_max(stage, 'cuda_growth_bytes', window['cuda_peak'] - window['cuda_start'])
+            if self.cpu_allocations:
+                self.spans.append((name, window['ns_start'], time.time_ns()))
+
+    def summary(self) -> str:
+        rows = sorted(self.report().items(), key=lambda item: -item[1].get('peak_rss_bytes', 0))
+        columns = ['stage', 'calls', 'seconds', 'peak rss MB', 'rss growth MB']
+        if self.cuda:
+            columns += ['cuda peak MB', 'cuda growth MB']
+        if self.cpu_allocations:
+            columns += ['cpu alloc peak MB', 'cpu allocated MB']
+        lines = [columns]
+        for name, stage in rows:
+            line = [name, str(stage['calls']), f"{stage['seconds']:.3f}",
+                    _mb(stage.get('peak_rss_bytes')), _mb(stage.get('rss_growth_bytes'))]
+            if self.cuda:
+                line += [_mb(stage.get('cuda_peak_bytes')), _mb(stage.get('cuda_growth_bytes'))]
+            if self.cpu_allocations:
+                line += [_mb(stage.get('cpu_alloc_peak_bytes')), _mb(stage.get('cpu_allocated_bytes'))]
+            lines.append(line)
+        return _format_table(lines)
+
+    def __enter__(self):
+        if self.cuda is None:
+            self.cuda = torch.cuda.is_available()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        if self.cpu_allocations:
+            self.torch_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True)
+            self.profile_start_ns = time.time_ns()
+            self.torch_profiler.__enter__()
+        self.stop.clear()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(*args)
+            self._fold_cpu_allocations()
+            self.torch_profiler = None
+        super().__exit__(*args)
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            rss = current_rss()
+            with self.lock:
+                for window in self.windows:
+                    window['rss_peak'] = max(window['rss_peak'], rss)
+
+    def _fold_cpu_allocations(self):
+        # memory events carry wall clock timestamps, each stage gets the
+        # allocations and frees that happened between its start and end
+        events = self._memory_events()
+        if events is None:
+            with self.lock:
+                self.spans = []
+            return
+        times = [t for t, _ in events]
+        with self.lock:
+            for name, start, end in self.spans:
+                live = peak = allocated = 0
+                for _, nbytes in events[bisect.bisect_left(times, start):bisect.bisect_right(times, end)]:
+                    live += nbytes
+                    peak = max(peak, live)
+                    allocated += max(nbytes, 0)
+                stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                _keep_max(stage, 'cpu_alloc_peak_bytes', peak)
+                stage['cpu_allocated_bytes'] = stage.get('cpu_allocated_bytes', 0) + allocated
+            self.spans = []
+
+    def _memory_events(self):
+        # (ns, bytes) of cpu allocations and frees, None when this torch
+        # version does not expose them the way they are read here
+        try:
+            results = self.torch_profiler.profiler.kineto_results
+            trace_start_ns = results.trace_start_ns()
+            events = sorted(
+                (event.start_ns(), event.nbytes()) for event in results.events()
+                if event.name() == '[memory]' and event.device_type() == torch.autograd.DeviceType.CPU
+            )
+        except (AttributeError, TypeError) as e:
+            warnings.warn(f"cpu_allocations are not recorded, torch {torch.__version__} has no readable profiler memory events: {e}")
+            return None
+        # stage bounds come from time.time_ns, the profiler has to use the same clock
+        if abs(trace_start_ns - self.profile_start_ns) > 10**10:
+            warnings.warn(f"cpu_allocations are not recorded, torch {torch.__version__} profiler timestamps are not wall clock time")
+            return None
+        return events
+
+    def _fold_cuda_peak(self):
+        # the allocator keeps a single peak, so it is handed to every open
+        # stage and reset whenever a stage starts or ends
+        peak = torch.cuda.max_memory_allocated()
+        with self.lock:
+            for window in self.windows:
+                window['cuda_peak'] = max(window['cuda_peak'], peak)
+        torch.cuda.reset_peak_memory_stats()
+
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    # lifetime peak, kilobytes on linux and bytes on macos
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _keep_max(stage: dict, key: str, value: int):
+    stage[key] = max(stage.get(key, 0), value)
+
+
+def _mb(value: int) -> str:
+    return '-' if value is None else f"{value / 2**20:.1f}"
+
+
+def _format_table(rows: List[List[str]]) -> str:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))) for row in rows)
@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+from ._lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# ", " between segments is a single BPE token
+SEPARATOR = ", "
+SEPARATOR_TOKENS = 1
+
+
+class TokenCounter():
+    """
+    Counts CLIP tokens of prompt text, without the start and end tokens. Label
+    tables seed `cache` when they are built, so counting a label is a dict
+    lookup. Counts of other text, captions and joined prompts, are kept for
+    the `recent_size` most recently counted texts only.
+
+    Only open_clip's SimpleTokenizer exposes `encode`. With any other tokenizer
+    the counter falls back to tokenizing whole prompts, like before.
+    """
+    def __init__(self, tokenize, recent_size: int = 64 * 1024):
+        self.tokenize = tokenize
+        self.encode = getattr(tokenize, 'encode', None)
+        self.max_tokens = (getattr(tokenize, 'context_length', None) or 77) - 2
+        self.cache: Dict[str, int] = {}
+        self.recent = OrderedDict()
+        self.recent_size = recent_size
+        self.lock = threading.Lock()
+        if self.incremental:
+            self.sot = tokenize.encoder['<start_of_text>']
+            self.eot = tokenize.encoder['<end_of_text>']
+            self.separator = self.encode(SEPARATOR.strip())[0]
+
+    @property
+    def incremental(self) -> bool:
+        return self.encode is not None
+
+    def count(self, text: str) -> int:
+        tokens = self.cache.get(text)
+        if tokens is not None:
+            return tokens
+        with self.lock:
+            if text in self.recent:
+                self.recent.move_to_end(text)
+                return self.recent[text]
+        tokens = len(self.encode(text)) if self.incremental else None
+        with self.lock:
+            self.recent[text] = tokens
+            while len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+        return tokens
+
+    def counts(self, texts: Iterable[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+    def update(self, texts: Iterable[str], counts: Iterable[int]):
+        self.cache.update(zip(texts, (int(c) for c in counts)))
+
+    def joined(self, text: str, tokens: int, segment: str) -> int:
+        # token count of text + ", " + segment. BPE splits on letters, digits
+        # and runs of punctuation, so counts only add up when the text does not
+        # end in punctuation that would merge with the comma. The space keeps
+        # the segment apart whatever it starts with
+        if text and segment and _clean_edge(text[-1]):
+            return tokens + SEPARATOR_TOKENS + self.count(segment)
+        if not text:
+            return self.count(segment)
+        return len(self.encode(text + SEPARATOR + segment))
+
+    def at_max_len(self, text: str, tokens: int = None) -> bool:
+        if not self.incremental:
+            return self.tokenize([text])[0][-1] != 0
+        return (self.count(text) if tokens is None else tokens) >= self.max_tokens
+
+    def split(self, text_tokens):
+        # tokenizer output -> (ids without start, end and padding as uint16 rows
+        # of max_tokens, lengths), the form label tables store their tokens in
+        text_tokens = np.asarray(text_tokens)
+        ids = text_tokens[:, 1:self.max_tokens+1].astype(np.uint16)
+        lengths = ((text_tokens == self.eot).argmax(1) - 1).astype(np.int16)
+        ids[np.arange(self.max_tokens) >= lengths[:, None]] = 0
+        return ids, lengths
+
+    def assemble(self, ids, lengths, prefix: str = None, labels: List[str] = None):
+        """
+        Tokenizer output for stored label ids, or for `prefix + ", " + label`
+        when a prefix is given, built by copying arrays instead of running BPE.
+        Rows equal what `tokenize` returns, truncation included. A prefix that
+        would merge with the comma falls back to tokenizing the whole strings.
+        """
+        if prefix is not None and not (prefix and _clean_edge(prefix[-1])):
+            return np.asarray(self.tokenize([prefix + SEPARATOR + label for label in labels]))
+
+        context_length = self.max_tokens + 2
+        head = [self.sot]
+        if prefix is not None:
+            head += self.encode(prefix) + [self.separator]
+        head = head[:context_length]
+
+        rows = len(ids)
+        out = np.zeros((rows, context_length), dtype=np.int64)
+        out[:, :len(head)] = head
+        width = min(ids.shape[1], context_length - len(head))
+        out[:, len(head):len(head)+width] = ids[:, :width]
+        end = np.minimum(len(head) + np.asarray(lengths, dtype=np.int64), context_length - 1)
+        out[np.arange(rows), end] = self.eot
+        return out
+
+
+class PromptBuilder():
+    """
+    Comma separated prompt that tracks its token count as segments are
+    appended, so length checks cost O(1) instead of re-tokenizing the prompt.
+    """
+    def __init__(self, counter: TokenCounter, text: str = '', tokens: int = None):
+        self.counter = counter
+        self.text = text
+        self.tokens = tokens
+        if tokens is None and counter.incremental:
+            self.tokens = counter.count(text) if text else 0
+
+    def tokens_with(self, segment: str) -> int:
+        return self.counter.joined(self.text, self.tokens, segment)
+
+    def fits(self, segment: str) -> bool:
+        if not self.counter.incremental:
+            return not self.counter.at_max_len(self._joined_text(segment))
+        return self.tokens_with(segment) < self.counter.max_tokens
+
+    def extended(self, segment: str) -> 'PromptBuilder':
+        tokens = self.tokens_with(segment) if self.counter.incremental else None
+        return PromptBuilder(self.counter, self._joined_text(segment), tokens)
+
+    @property
+    def at_max_len(self) -> bool:
+        return self.counter.at_max_len(self.text, self.tokens)
+
+    def _joined_text(self, segment: str) -> str:
+        return self.text + SEPARATOR + segment if self.text else segment
+
+
+def truncate_to_fit(text: str, counter: TokenCounter) -> str:
+    # keeps whole comma separated parts while the prompt stays under the context length
+    parts = text.split(SEPARATOR)
+    prompt = PromptBuilder(counter, parts[0])
+    for part in parts[1:]:
+        if not prompt.fits(part):
+            break
+        prompt = prompt.extended(part)
+    return prompt.text
+
+
+def _clean_edge(char: str) -> bool:
+    return char.isalnum() or char.isspace()
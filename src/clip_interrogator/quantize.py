@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from typing import List
+from ._lazy import lazy_import
+
+torch = lazy_import('torch')
+nn = lazy_import('torch.nn')
+
+
+def quantize_linear(module: nn.Module) -> nn.Module:
+    # dynamic int8: weights are quantized once, activations per batch at run time
+    module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    for m in module.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            # open_clip reads the compute dtype from the first mlp weight
+            m.int8_original_dtype = torch.float32
+    return module
+
+
+def quantize_blip(blip_model: nn.Module) -> nn.Module:
+    blip_model.visual_encoder = quantize_linear(blip_model.visual_encoder)
+    blip_model.text_decoder = quantize_linear(blip_model.text_decoder)
+    return blip_model
+
+
+def quantize_clip_text(clip_model: nn.Module) -> nn.Module:
+    # only the text tower, it is run for every label and every flavor chain candidate
+    # while the image tower runs once per image
+    if hasattr(clip_model, 'text'):
+        clip_model.text = quantize_linear(clip_model.text)
+    else:
+        clip_model.transformer = quantize_linear(clip_model.transformer)
+    return clip_model
+
+
+def validation_report(reference, candidate, images: List, top_count: int = 10) -> dict:
+    """
+    Args:
+        reference (ClipInterrogator): full precision interrogator
+        candidate (ClipInterrogator): interrogator to check, e.g. with quantize or cpu_bf16
+        images (list): PIL images to compare on
+        top_count (int): number of ranked labels compared per table
+    """
+    from .evaluate import TABLES as tables, table_recall
+    for ci in (reference, candidate):
+        if not hasattr(ci, 'flavors'):
+            ci.prepare_labels()
+
+    report = {'images': [], 'caption_match': 0.0, 'recall': {name: 0.0 for name in tables}, 'feature_cosine': 0.0}
+    for image in images:
+        ref_caption, cand_caption = reference.generate_caption(image), candidate.generate_caption(image)
+        ref_features, cand_features = reference.image_to_features(image), candidate.image_to_features(image)
+        cosine = (ref_features.float() @ cand_features.float().T)[0][0].item()
+
+        recall = table_recall(reference, candidate, ref_features, cand_features, top_count)
+        for name in tables:
+            report['recall'][name] += recall[name] / len(images)
+
+        report['caption_match'] += (ref_caption == cand_caption) / len(images)
+        report['feature_cosine'] += cosine / len(images)
+        report['images'].append({
+            'reference_caption': ref_caption,
+            'candidate_caption': cand_caption,
+            'feature_cosine': cosine,
+            'recall': recall,
+        })
+    return report
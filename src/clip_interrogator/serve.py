@@ -0,0 +1,250 @@
+import base64
+import binascii
+import hashlib
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from .batch import MODES, interrogate_images
+from .cache import MemoryCache
+from .pipeline import load_image
+
+# lanes in the order the scheduler drains them
+LANES = ('interactive', 'bulk')
+
+
+class Job():
+    def __init__(self, key: tuple, image, texts: List[str] = None):
+        self.key = key
+        self.image = image
+        self.texts = texts
+        self.future = Future()
+
+
+class Scheduler():
+    """
+    Runs queued jobs on one model thread. Jobs with the same key (kind, mode,
+    max_flavors) are batched together, up to `batch_size` of them or whatever
+    arrived within `max_wait` seconds. Interactive jobs are always taken before
+    bulk ones, and `submit` raises queue.Full once a lane holds `queue_size` jobs.
+    """
+    def __init__(self, ci, batch_size: int = 8, max_wait: float = 0.01, queue_size: int = 64):
+        self.ci = ci
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+        self.lanes = {lane: deque() for lane in LANES}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # the running batch finishes, queued jobs fail so no caller waits forever
+        with self.cond:
+            self.closed = True
+            pending = [job for lane in LANES for job in self.lanes[lane]]
+            for jobs in self.lanes.values():
+                jobs.clear()
+            self.cond.notify_all()
+        for job in pending:
+            job.future.set_exception(Exception("Scheduler closed before the job ran"))
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, job: Job, lane: str = 'interactive') -> Future:
+        if lane not in self.lanes:
+            raise Exception(f"Unknown priority {lane}, expected one of {', '.join(LANES)}")
+        with self.cond:
+            if self.closed:
+                raise Exception("Scheduler is closed")
+            if len(self.lanes[lane]) >= self.queue_size:
+                raise queue.Full(lane)
+            self.lanes[lane].append(job)
+            self.cond.notify_all()
+        return job.future
+
+    def depths(self) -> dict:
+        with self.cond:
+            return {lane: len(jobs) for lane, jobs in self.lanes.items()}
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self._execute(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    continue
+                # one bad job must not fail its batch mates, each is rerun alone
+                for job in batch:
+                    try:
+                        job.future.set_result(self._execute([job])[0])
+                    except Exception as e:
+                        job.future.set_exception(e)
+                continue
+            for job, result in zip(batch, results):
+                job.future.set_result(result)
+
+    def _next_batch(self) -> List[Job]:
+        with self.cond:
+            while not self.closed and not any(self.lanes.values()):
+                self.cond.wait()
+            if self.closed:
+                return None
+            first = next(self.lanes[lane] for lane in LANES if self.lanes[lane]).popleft()
+            batch, deadline = [first], time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                job = self._take(first.key)
+                if job is not None:
+                    batch.append(job)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.closed:
+                    break
+                self.cond.wait(remaining)
+            return batch
+
+    def _take(self, key: tuple) -> Job:
+        for lane in LANES:
+            for job in self.lanes[lane]:
+                if job.key == key:
+                    self.lanes[lane].remove(job)
+                    return job
+        return None
+
+    def _execute(self, batch: List[Job]) -> list:
+        kind, mode, max_flavors = batch[0].key
+        images = [job.image for job in batch]
+        if kind == 'interrogate':
+            return interrogate_images(self.ci, images, mode, max_flavors)
+
+        # one matrix for the batch, every image against the texts of every job
+        texts = list(dict.fromkeys(text for job in batch for text in job.texts))
+        result = self.ci.score(self.ci.images_to_features(images), texts)
+        results = []
+        for i, job in enumerate(batch):
+            scores = result.to_dict(i)
+            results.append({text: scores[text] for text in job.texts})
+        return results
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    POST /interrogate {"image": base64, "mode": "best", "max_flavors": null, "priority": "interactive"}
+    POST /flavors     {"image": base64, "max_flavors": null, "priority": "interactive"}
+    POST /score       {"image": base64, "texts": [...], "priority": "interactive"}
+    GET  /health
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': f"Unknown path {self.path}"})
+        self._send(200, {'status': 'ok', 'queued': self.server.scheduler.depths()})
+
+    def do_POST(self):
+        if self.path not in ('/interrogate', '/flavors', '/score'):
+            return self._send(404, {'error': f"Unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            data = base64.b64decode(request['image'], validate=True)
+            key, texts = self._job_key(request)
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            return self._send(400, {'error': f"Invalid request: {e}"})
+
+        cache_key = f"{key}:{hashlib.sha256(data).hexdigest()}"
+        if texts is not None:
+            cache_key += ':' + hashlib.sha256(json.dumps(texts).encode()).hexdigest()
+        result = self.server.result_cache.get(cache_key)
+        if result is not None:
+            return self._send(200, self._body(key, result, cached=True))
+
+        try:
+            image = load_image(io.BytesIO(data), self.server.draft_size)
+        except Exception as e:
+            return self._send(400, {'error': f"Invalid image: {e}"})
+        try:
+            future = self.server.scheduler.submit(Job(key, image, texts), request.get('priority', 'interactive'))
+        except queue.Full:
+            return self._send(429, {'error': "Queue is full, retry later"}, {'Retry-After': '1'})
+        except Exception as e:
+            return self._send(400, {'error': str(e)})
+
+        try:
+            result = future.result()
+        except Exception as e:
+            return self._send(500, {'error': str(e)})
+        self.server.result_cache.set(cache_key, result)
+        self._send(200, self._body(key, result, cached=False))
+
+    def _job_key(self, request: dict):
+        max_flavors = request.get('max_flavors')
+        if max_flavors is not None:
+            max_flavors = int(max_flavors)
+        if self.path == '/score':
+            texts = request['texts']
+            if not texts or not all(isinstance(text, str) for text in texts):
+                raise ValueError("texts must be a non-empty list of strings")
+            return ('score', None, None), list(texts)
+        mode = 'flavors' if self.path == '/flavors' else request.get('mode', 'best')
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, expected one of {', '.join(MODES)}")
+        return ('interrogate', mode, max_flavors), None
+
+    def _body(self, key: tuple, result, cached: bool) -> dict:
+        if key[0] == 'score':
+            return {'scores': result, 'cached': cached}
+        return {'prompt': result, 'mode': key[1], 'cached': cached}
+
+    def _send(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(ci, host: str = '127.0.0.1', port: int = 8000, batch_size: int = 8, max_wait: float = 0.01,
+                queue_size: int = 64, result_cache_size: int = 64 * 1024 * 1024, draft_size: int = None,
+                quiet: bool = False, scheduler: Scheduler = None) -> ThreadingHTTPServer:
+    """
+    Builds the HTTP server, call serve_forever() on the result. Port 0 picks
+    a free port, see server.server_address. A `scheduler` passed in has to be
+    started by the caller.
+
+    Args:
+        ci (ClipInterrogator): interrogator, prepare_labels must have been called for every mode except caption and flavors
+        batch_size (int): jobs per BLIP and CLIP forward pass
+        max_wait (float): seconds a partial batch waits for more jobs
+        queue_size (int): jobs per priority lane before requests get a 429
+        result_cache_size (int): bytes of results kept, keyed by image bytes and request parameters
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    if scheduler is None:
+        scheduler = Scheduler(ci, batch_size, max_wait, queue_size)
+        scheduler.start()
+    server.scheduler = scheduler
+    server.result_cache = MemoryCache(result_cache_size)
+    server.draft_size = draft_size
+    server.quiet = quiet
+    return server
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from typing import Iterable, Iterator, List, Tuple
+from .batch import RECORD_FIELDS, open_writer
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    # "i/N" with 0 <= i < N
+    try:
+        index, count = (int(x) for x in spec.split('/'))
+    except ValueError:
+        raise Exception(f"Invalid shard {spec}, expected i/N")
+    if count < 1 or not 0 <= index < count:
+        raise Exception(f"Invalid shard {spec}, expected 0 <= i < N")
+    return index, count
+
+
+def shard_of(path: str, source_dir: str, count: int) -> int:
+    # hash of the path relative to the walked directory, so machines that
+    # mount the dataset in different places still agree on the partition
+    relpath = os.path.relpath(path, source_dir).replace(os.sep, '/')
+    return int(hashlib.sha1(relpath.encode()).hexdigest()[:16], 16) % count
+
+
+def shard_paths(paths: Iterable[str], source_dir: str, index: int, count: int) -> Iterator[str]:
+    source_dir = os.path.abspath(source_dir)
+    for path in paths:
+        if shard_of(path, source_dir, count) == index:
+            yield path
+
+
+def shard_output_path(output: str, index: int, count: int) -> str:
+    # out.jsonl -> out.shard-00001-of-00004.jsonl
+    root, ext = os.path.splitext(output)
+    return f"{root}.shard-{index:05d}-of-{count:05d}{ext}"
+
+
+def core_groups(count: int) -> List[List[int]]:
+    # contiguous groups so a worker's threads share caches, with more groups
+    # than cores the groups are single cores shared round robin
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    count = max(1, count)
+    if count > len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(count)]
+    size, extra = divmod(len(cpus), count)
+    groups, start = [], 0
+    for i in range(count):
+        stop = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:stop])
+        start = stop
+    return groups
+
+
+def launch_commands(batch_argv: List[str], procs: int, node: Tuple[int, int] = (0, 1)) -> List[Tuple[List[str], dict, List[int]]]:
+    """
+    Builds `procs` `batch` workers, one per core group. With `node` = (i, N)
+    this host runs shards i*procs .. i*procs+procs-1 of N*procs, so N hosts
+    each started with their own node index cover the whole walk, whatever
+    their core counts.
+    """
+    node_index, node_count = node
+    procs = max(1, procs)
+    total = node_count * procs
+    commands = []
+    for i, cpus in enumerate(core_groups(procs)):
+        shard = node_index * procs + i
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            env[var] = str(len(cpus))
+        cmd = [sys.executable, '-m', 'clip_interrogator', 'batch', *batch_argv,
+               '--shard', f"{shard}/{total}", '--threads', str(len(cpus))]
+        commands.append((cmd, env, cpus))
+    return commands
+
+
+def launch(batch_argv: List[str], procs: int, node: Tuple[int, int] = (0, 1)) -> int:
+    workers = []
+    for cmd, env, cpus in launch_commands(batch_argv, procs, node):
+        pin = (lambda cpus=cpus: os.sched_setaffinity(0, cpus)) if hasattr(os, 'sched_setaffinity') else None
+        workers.append(subprocess.Popen(cmd, env=env, preexec_fn=pin))
+    # first failure wins, a worker killed by a signal has a negative code
+    codes = [worker.wait() for worker in workers]
+    return next((code if code > 0 else 1 for code in codes if code != 0), 0)
+
+
+def read_records(path: str) -> Iterator[dict]:
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        yield from pq.read_table(path).to_pylist()
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue # torn last line of an interrupted run
+
+
+def merge_outputs(inputs: List[str], output: str) -> dict:
+    # resumed runs can repeat a record, keep one per path and prefer successes
+    records = {}
+    for path in inputs:
+        for record in read_records(path):
+            previous = records.get(record['path'])
+            if previous is None or previous.get('error') or not record.get('error'):
+                records[record['path']] = record
+    writer = open_writer(output)
+    for path in sorted(records):
+        writer.write({name: records[path].get(name) for name in RECORD_FIELDS})
+    writer.close()
+    return {'inputs': len(inputs), 'records': len(records), 'failed': sum(1 for r in records.values() if r.get('error'))}
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import open_clip
+import torch
+from open_clip.model import CLIP, CLIPTextCfg, CLIPVisionCfg
+from PIL import Image
+from typing import List
+from .blip import BLIP_Decoder
+from .blip.med import BertConfig
+from .clip_interrogator import Config, _load_list
+
+# tiny random-weight models so tests and benchmarks run offline on cpu,
+# the prompts they produce are meaningless but every code path is exercised
+
+TINY_CLIP_MODEL_NAME = 'tiny/random'
+TINY_IMAGE_SIZE = 64
+
+
+def tiny_clip_model(seed: int = 0):
+    torch.manual_seed(seed)
+    model = CLIP(
+        embed_dim=32,
+        vision_cfg=CLIPVisionCfg(layers=2, width=64, patch_size=16, image_size=TINY_IMAGE_SIZE),
+        text_cfg=CLIPTextCfg(context_length=77, vocab_size=49408, width=64, heads=2, layers=2),
+    )
+    preprocess = open_clip.image_transform(TINY_IMAGE_SIZE, is_train=False)
+    return model.eval(), preprocess
+
+
+def tiny_blip_model(seed: int = 0) -> BLIP_Decoder:
+    torch.manual_seed(seed)
+    med_config = BertConfig(
+        vocab_size=30524,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        max_position_embeddings=512,
+        add_cross_attention=True,
+    )
+    return BLIP_Decoder(med_config=med_config, image_size=TINY_IMAGE_SIZE, vit='tiny').eval()
+
+
+def tiny_data(path: str, count: int = 64) -> str:
+    # first `count` entries of each bundled label list
+    os.makedirs(path, exist_ok=True)
+    data_path = Config.data_path
+    for filename in os.listdir(data_path):
+        if filename.endswith('.txt'):
+            items = _load_list(data_path, filename)[:count]
+            with open(os.path.join(path, filename), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(items))
+    return path
+
+
+def tiny_config(cache_path: str, label_count: int = 64, seed: int = 0, **kwargs) -> Config:
+    clip_model, clip_preprocess = tiny_clip_model(seed)
+    config = Config(
+        blip_model=tiny_blip_model(seed),
+        blip_image_eval_size=TINY_IMAGE_SIZE,
+        blip_num_beams=2,
+        blip_max_length=12,
+        clip_model_name=TINY_CLIP_MODEL_NAME,
+        cache_path=cache_path,
+        data_path=tiny_data(os.path.join(cache_path, 'data'), label_count),
+        device='cpu',
+        quiet=True,
+        **kwargs
+    )
+    config.clip_model = clip_model
+    config.clip_preprocess = clip_preprocess
+    return config
+
+
+def random_images(count: int, size: int = TINY_IMAGE_SIZE * 2, seed: int = 0) -> List[Image.Image]:
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8)) for _ in range(count)]
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Tuple
+from PIL import Image
+from .batch import interrogate_images
+
+
+@dataclass
+class Segment:
+    start: int # position of the first frame in the sequence
+    end: int # position of the last frame
+    prompt: str
+    start_time: float = None # seconds, when frames come with timestamps
+    end_time: float = None
+
+
+def read_video(path: str, every: int = 1) -> Iterator[Tuple[float, Image.Image]]:
+    # (seconds, frame) for every `every`-th decoded frame, needs PyAV
+    try:
+        import av
+    except ImportError:
+        raise Exception("Video decoding requires PyAV, install it with `pip install av`")
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        for i, frame in enumerate(container.decode(stream)):
+            if i % every == 0:
+                yield frame.time, frame.to_image().convert('RGB')
+
+
+def interrogate_frames(ci, frames: Iterable, mode: str = 'best', threshold: float = 0.9, batch_size: int = 8,
+                       max_flavors: int = None) -> Iterator[Segment]:
+    """
+    Splits a frame sequence into segments of similar frames and interrogates
+    only the first frame of each. A frame starts a new segment when the cosine
+    similarity of its CLIP image features with the segment's first frame drops
+    below `threshold`. Segments are yielded as soon as they end, so long videos
+    stream.
+
+    Args:
+        ci (ClipInterrogator): interrogator, prepare_labels must have been called for every mode except caption and flavors
+        frames (iterable): PIL images, or (seconds, image) pairs as read_video yields them
+        mode (str): one of batch.MODES
+        batch_size (int): frames per CLIP image feature pass
+    """
+    segment, key_features = None, None
+    batch: List[Tuple[int, float, Image.Image]] = []
+
+    def run(batch):
+        nonlocal segment, key_features
+        image_features = ci.images_to_features([image for _, _, image in batch])
+        for row, (index, seconds, image) in enumerate(batch):
+            features = image_features[row:row+1]
+            if key_features is not None and (features @ key_features.T).item() >= threshold:
+                segment.end, segment.end_time = index, seconds
+                continue
+            if segment is not None:
+                yield segment
+            prompt = interrogate_images(ci, [image], mode, max_flavors, features)[0]
+            segment, key_features = Segment(index, index, prompt, seconds, seconds), features
+
+    for index, frame in enumerate(frames):
+        seconds, image = frame if isinstance(frame, tuple) else (None, frame)
+        batch.append((index, seconds, image))
+        if len(batch) >= batch_size:
+            yield from run(batch)
+            batch = []
+    if batch:
+        yield from run(batch)
+    if segment is not None:
+        yield segment
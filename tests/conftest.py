@@ -0,0 +1,15 @@
+import pytest
+from src.clip_interrogator.clip_interrogator import ClipInterrogator
+from src.clip_interrogator.testing import random_images, tiny_config
+
+
+@pytest.fixture
+def tiny_ci(tmp_path):
+    ci = ClipInterrogator(tiny_config(str(tmp_path)))
+    ci.prepare_labels()
+    return ci
+
+
+@pytest.fixture
+def images():
+    return random_images(2)
@@ -0,0 +1,135 @@
+import json
+import os
+import pytest
+import torch
+from src.clip_interrogator.batch import Manifest, _file_hash, interrogate_images, iter_images, run_batch
+from src.clip_interrogator.dedup import DedupIndex
+from src.clip_interrogator.shard import merge_outputs
+from src.clip_interrogator.testing import random_images
+
+
+def _write_images(path, count, seed=0):
+    path.mkdir(exist_ok=True)
+    for i, image in enumerate(random_images(count, seed=seed)):
+        image.save(str(path / f"{seed}_{i}.png"))
+
+
+def _read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_iter_images(tmp_path):
+    _write_images(tmp_path / 'b', 2)
+    _write_images(tmp_path / 'a', 2)
+    (tmp_path / 'a' / 'notes.txt').write_text('')
+    paths = list(iter_images(str(tmp_path)))
+    assert len(paths) == 4
+    assert paths == sorted(paths)
+
+
+def test_interrogate_images_matches_single(tiny_ci, images):
+    assert interrogate_images(tiny_ci, images, 'fast') == [tiny_ci.interrogate_fast(image) for image in images]
+    assert interrogate_images(tiny_ci, images, 'caption') == [tiny_ci.generate_caption(image) for image in images]
+
+
+def test_run_batch_resumes(tiny_ci, tmp_path):
+    source = tmp_path / 'images'
+    _write_images(source, 5)
+    (source / 'broken.png').write_bytes(b'not an image')
+    output = str(tmp_path / 'out.jsonl')
+
+    stats = run_batch(tiny_ci, iter_images(str(source)), output, mode='fast', batch_size=2, workers=2, flush_every=2)
+    assert stats == {'processed': 5, 'skipped': 0, 'failed': 1}
+    rows = _read_jsonl(output)
+    assert len(rows) == 6
+    assert all(row['prompt'] and len(row['hash']) == 64 for row in rows if row['error'] is None)
+
+    _write_images(source, 1, seed=1)
+    stats = run_batch(tiny_ci, iter_images(str(source)), output, mode='fast', batch_size=2)
+    assert stats == {'processed': 1, 'skipped': 5, 'failed': 1}
+    assert len(Manifest(output + '.manifest.jsonl').done) == 6
+
+
+def test_manifest_ignores_torn_line(tmp_path):
+    image_path = tmp_path / 'a.png'
+    random_images(1)[0].save(str(image_path))
+    manifest = Manifest(str(tmp_path / 'manifest.jsonl'))
+    manifest.add(str(image_path), 'abc')
+    manifest.close()
+    with open(tmp_path / 'manifest.jsonl', 'a') as f:
+        f.write('{"path": "/trunc')
+    manifest = Manifest(str(tmp_path / 'manifest.jsonl'))
+    assert manifest.is_done(str(image_path))
+    manifest.add(str(image_path), 'abc')
+    manifest.close()
+    assert len(Manifest(str(tmp_path / 'manifest.jsonl')).done) == 1
+
+
+def test_manifest_verify_hash(tmp_path):
+    image_path = str(tmp_path / 'a.bin')
+    with open(image_path, 'wb') as f:
+        f.write(b'a' * 64)
+    manifest = Manifest(str(tmp_path / 'manifest.jsonl'))
+    manifest.add(image_path, _file_hash(image_path))
+    manifest.close()
+
+    # same size rewrite with the mtime restored
+    stat = os.stat(image_path)
+    with open(image_path, 'wb') as f:
+        f.write(b'b' * 64)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert Manifest(str(tmp_path / 'manifest.jsonl')).is_done(image_path)
+    assert not Manifest(str(tmp_path / 'manifest.jsonl'), verify_hash=True).is_done(image_path)
+
+
+def test_run_batch_parquet(tiny_ci, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    source = tmp_path / 'images'
+    _write_images(source, 3)
+    output = str(tmp_path / 'out.parquet')
+    run_batch(tiny_ci, iter_images(str(source)), output, mode='caption', batch_size=2, flush_every=2)
+    table = pq.read_table(str(tmp_path / 'out.00000.parquet'))
+    rows = table.to_pylist() + pq.read_table(str(tmp_path / 'out.00001.parquet')).to_pylist()
+    assert len(rows) == 3
+
+
+def test_dedup_index():
+    features = torch.nn.functional.normalize(torch.randn(3, 16), dim=-1)
+    near = torch.nn.functional.normalize(features[0] + 0.01 * torch.randn(16), dim=-1)
+    index = DedupIndex(threshold=0.95)
+    assert index.assign(torch.stack([features[0], near, features[1]])) == [0, 0, 1]
+    assert index.assign(torch.stack([features[2], features[1]])) == [2, 1]
+    assert index.count == 3
+
+
+def test_run_batch_dedup(tiny_ci, tmp_path):
+    source = tmp_path / 'images'
+    _write_images(source, 3)
+    for i, image in enumerate(random_images(3)):
+        image.save(str(source / f"copy_{i}.jpg"), quality=95)
+    output = str(tmp_path / 'out.jsonl')
+
+    # the random-weight model finds all noise images alike, the jpeg copies are closer still
+    stats = run_batch(tiny_ci, iter_images(str(source)), output, mode='fast', batch_size=4, dedup_threshold=0.997)
+    assert stats['processed'] == 6 and stats['duplicates'] == 3 and stats['representatives'] == 3
+    assert stats['saved_fraction'] == 0.5
+    rows = {row['path']: row for row in _read_jsonl(output)}
+    for i in range(3):
+        copy = rows[str(source / f"copy_{i}.jpg")]
+        original = rows[copy['duplicate_of']]
+        assert copy['prompt'] == original['prompt'] and original['duplicate_of'] is None
+
+
+def test_rerun_retries_failures_and_merge_keeps_one_record(tiny_ci, tmp_path):
+    source = tmp_path / 'images'
+    _write_images(source, 2)
+    (source / 'broken.png').write_bytes(b'not an image')
+    output = str(tmp_path / 'out.jsonl')
+    for _ in range(2):
+        run_batch(tiny_ci, iter_images(str(source)), output, mode='caption')
+    broken = [row for row in _read_jsonl(output) if row['path'].endswith('broken.png')]
+    assert len(broken) == 2 and all(row['error'] for row in broken)
+
+    stats = merge_outputs([output], str(tmp_path / 'merged.jsonl'))
+    assert stats == {'inputs': 1, 'records': 3, 'failed': 1}
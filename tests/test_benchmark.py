@@ -0,0 +1,20 @@
+import json
+from src.clip_interrogator.benchmark import compare, run_benchmark, write_results
+
+
+def test_benchmark(tmp_path):
+    results = run_benchmark(label_counts=(16, 32), batch_sizes=(1, 2), repeat=1, warmup=0, max_flavors=2, chunk_size=16)
+    assert results['meta']['chunk_size'] == 16
+    names = {r['name'] for r in results['results']}
+    assert {'label_table_build', 'rank', 'flavor_chain', 'generate_caption', 'image_to_features', 'interrogate_fast'} <= names
+    assert {r['labels'] for r in results['results'] if r['name'] == 'rank'} == {16, 32}
+    assert {r['batch_size'] for r in results['results'] if r['name'] == 'generate_caption'} == {1, 2}
+
+    path = str(tmp_path / 'bench.json')
+    write_results(results, path)
+    baseline = json.load(open(path))
+    assert compare(baseline, results) == []
+
+    slower = json.loads(json.dumps(results))
+    slower['results'][0]['median_ms'] = baseline['results'][0]['median_ms'] * 2 + 1
+    assert [r['name'] for r in compare(baseline, slower)] == [results['results'][0]['name']]
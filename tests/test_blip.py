@@ -0,0 +1,11 @@
+from src.clip_interrogator.blip.blip import init_tokenizer
+
+
+def test_init_tokenizer():
+    tokenizer = init_tokenizer()
+    assert tokenizer.is_fast
+    assert len(tokenizer) == 30524
+    assert tokenizer.bos_token_id == 30522
+    assert tokenizer.enc_token_id == 30523
+    assert tokenizer('a picture of ').input_ids == [101, 1037, 3861, 1997, 102]
+    assert tokenizer.decode([101, 1037, 4937, 2015, 102], skip_special_tokens=True) == 'a cats'
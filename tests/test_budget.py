@@ -0,0 +1,48 @@
+import json
+from src.clip_interrogator.batch import iter_images, run_batch
+from src.clip_interrogator.budget import Budget
+
+
+def test_unlimited_budget_matches_unbudgeted(tiny_ci, images):
+    tiny_ci.config.budget_batch_size = 16
+    budget = Budget(seconds=3600)
+    assert tiny_ci.interrogate(images[0], max_flavors=4, budget=budget) == tiny_ci.interrogate(images[0], max_flavors=4)
+    report = budget.report()
+    assert not report['exhausted'] and report['stopped_in'] is None
+    assert report['texts'] >= 16 and 0 <= report['flavors'] <= 4
+
+
+def test_compute_budget_stops_between_micro_batches(tiny_ci, images):
+    tiny_ci.config.budget_batch_size = 8
+    caption = tiny_ci.generate_caption(images[0])
+    budget = Budget(texts=16 + 8)
+    prompt = tiny_ci.interrogate(images[0], max_flavors=8, caption=caption, budget=budget)
+    report = budget.report()
+    assert report['exhausted'] and report['stopped_in'] == 'flavor_chain'
+    assert report['texts'] == 24 and report['flavors'] <= 1
+    assert prompt.startswith(caption)
+
+
+def test_spent_budget_returns_caption(tiny_ci, images):
+    caption = tiny_ci.generate_caption(images[0])
+    budget = Budget(seconds=0)
+    assert tiny_ci.interrogate(images[0], caption=caption, budget=budget) == caption
+    assert budget.report()['stopped_in'] == 'check_multi_batch' and budget.report()['texts'] == 0
+
+    # a default budget from the config applies when none is passed
+    tiny_ci.config.compute_budget = 0
+    assert tiny_ci.interrogate(images[0], caption=caption) == caption
+
+
+def test_config_budget_report_is_kept(tiny_ci, images, tmp_path):
+    tiny_ci.config.compute_budget = 0
+    steps = list(tiny_ci.interrogate_iter(images[0], max_flavors=4))
+    assert steps[-1].budget.report()['stopped_in'] == 'check_multi_batch'
+
+    source = tmp_path / 'images'
+    source.mkdir()
+    images[0].save(str(source / 'a.png'))
+    run_batch(tiny_ci, iter_images(str(source)), str(tmp_path / 'out.jsonl'), mode='best', max_flavors=4)
+    with open(tmp_path / 'out.jsonl') as f:
+        record = json.loads(f.readline())
+    assert json.loads(record['budget'])['exhausted'] is True
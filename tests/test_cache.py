@@ -0,0 +1,65 @@
+import numpy as np
+from unittest.mock import patch
+from src.clip_interrogator.cache import DiskCache, MemoryCache, image_hash
+from src.clip_interrogator.clip_interrogator import ClipInterrogator
+from src.clip_interrogator.testing import random_images, tiny_config
+
+
+def test_memory_cache_eviction():
+    cache = MemoryCache(max_bytes=2048)
+    for i in range(4):
+        cache.set(str(i), np.zeros(256, dtype=np.float32))
+    assert cache.get('0') is None
+    assert cache.get('3') is not None
+    assert cache.size <= 2048
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=10_000)
+    cache.set('a', 'a caption')
+    assert DiskCache(str(tmp_path)).get('a') == 'a caption'
+    assert cache.get('missing') is None
+    for i in range(10):
+        cache.set(str(i), np.zeros(500, dtype=np.float32))
+    assert cache.size <= 10_000
+
+
+def test_image_hash():
+    a, b = random_images(2)
+    assert image_hash(a) == image_hash(a.copy())
+    assert image_hash(a) != image_hash(b)
+
+
+def test_interrogate_reuses_cached_vision_outputs(tmp_path, images):
+    config = tiny_config(str(tmp_path), image_cache_path=str(tmp_path / 'images'))
+    ci = ClipInterrogator(config)
+    ci.prepare_labels()
+    first = ci.interrogate_fast(images[0])
+
+    ci = ClipInterrogator(config)
+    ci.prepare_labels()
+    with patch.object(ci.blip_model, 'generate') as generate, \
+         patch.object(ci.clip_model, 'encode_image') as encode_image:
+        assert ci.interrogate_fast(images[0]) == first
+        assert ci.interrogate_flavors(images[0]) is not None
+    generate.assert_not_called()
+    encode_image.assert_not_called()
+
+
+def test_injected_models_have_their_own_cache_keys(tmp_path, images):
+    cache = MemoryCache(1024 * 1024)
+    first = ClipInterrogator(tiny_config(str(tmp_path), image_cache=cache))
+    other = ClipInterrogator(tiny_config(str(tmp_path), seed=1, image_cache=cache))
+    again = ClipInterrogator(tiny_config(str(tmp_path), image_cache=cache))
+    for kind in ('caption', 'features'):
+        assert first._image_cache_key(kind, images[0]) != other._image_cache_key(kind, images[0])
+        assert first._image_cache_key(kind, images[0]) == again._image_cache_key(kind, images[0])
+
+
+def test_cached_features_do_not_keep_the_batch(tmp_path, images):
+    cache = MemoryCache(1024 * 1024)
+    ci = ClipInterrogator(tiny_config(str(tmp_path), image_cache=cache))
+    ci.images_to_features(images)
+    rows = [value for value, _ in cache.entries.values()]
+    assert len(rows) == len(images)
+    assert all(row.untyped_storage().nbytes() == row.nbytes for row in rows)
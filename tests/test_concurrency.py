@@ -0,0 +1,75 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from src.clip_interrogator.clip_interrogator import ClipInterrogator
+from src.clip_interrogator.testing import random_images, tiny_config
+
+
+def test_concurrent_requests_match_sequential(tiny_ci):
+    images = random_images(4)
+    requests = [(method, image) for method in ('interrogate_fast', 'interrogate_flavors', 'interrogate_classic') for image in images]
+    expected = [getattr(tiny_ci, method)(image) for method, image in requests]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda r: getattr(tiny_ci, r[0])(r[1]), requests * 2))
+    assert results == expected * 2
+    assert not hasattr(tiny_ci, 'flavors_reduced')
+
+
+def test_blip_offload_is_shared_between_threads(tmp_path):
+    ci = ClipInterrogator(tiny_config(str(tmp_path), blip_offload=True))
+    images = random_images(6)
+    model = ci.blip_model
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        captions = list(pool.map(ci.generate_caption, images))
+    assert captions == [ci.generate_caption(image) for image in images]
+    assert ci.blip_model is model
+    assert ci._blip_users == 0
+
+
+def test_async_requests_are_batched(tiny_ci):
+    images = random_images(4)
+    sizes = []
+    generate_captions = tiny_ci.generate_captions
+    def spy(batch):
+        sizes.append(len(batch))
+        return generate_captions(batch)
+    tiny_ci.generate_captions = spy
+
+    async def run():
+        best = await asyncio.gather(*[tiny_ci.ainterrogate(image, max_flavors=4) for image in images])
+        fast = await asyncio.gather(*[tiny_ci.ainterrogate_fast(image) for image in images])
+        flavors = await asyncio.gather(*[tiny_ci.ainterrogate_flavors(image) for image in images])
+        return best, fast, flavors
+
+    best, fast, flavors = asyncio.run(run())
+    assert sizes[0] == len(images)
+    assert best == [tiny_ci.interrogate(image, max_flavors=4) for image in images]
+    assert fast == [tiny_ci.interrogate_fast(image) for image in images]
+    assert flavors == [tiny_ci.interrogate_flavors(image) for image in images]
+
+
+def test_close_stops_async_threads(tiny_ci):
+    image = random_images(1)[0]
+    fast = asyncio.run(tiny_ci.ainterrogate_fast(image))
+    executors = [batcher.executor for batcher in tiny_ci._batchers.values()] + [tiny_ci._chain_executor]
+    tiny_ci.close()
+    assert all(executor._shutdown for executor in executors)
+    assert not tiny_ci._batchers and tiny_ci._chain_executor is None
+    assert asyncio.run(tiny_ci.ainterrogate_fast(image)) == fast
+    tiny_ci.close()
+
+
+def test_reduced_flavor_table_is_built_outside_the_shared_lock(tiny_ci):
+    tiny_ci._flavors_reduced = None
+    LabelTable = type(tiny_ci.flavors)
+    build = LabelTable.__init__
+    held = []
+    def spy(self, *args, **kwargs):
+        held.append(tiny_ci._lock.locked())
+        build(self, *args, **kwargs)
+    with patch.object(LabelTable, '__init__', spy):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            tables = list(pool.map(lambda _: tiny_ci._flavors_reduced_table(), range(4)))
+    assert held == [False]
+    assert all(table is tables[0] for table in tables)
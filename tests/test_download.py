@@ -0,0 +1,88 @@
+import hashlib
+import os
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.clip_interrogator.download import download_file, resolve_source, verify_file
+
+PAYLOAD = os.urandom(300_000)
+PAYLOAD_MD5 = hashlib.md5(PAYLOAD).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    ranges = []
+
+    def do_GET(self):
+        start = 0
+        header = self.headers.get('Range')
+        RangeHandler.ranges.append(header)
+        if header:
+            start = int(header.split('=')[1].split('-')[0])
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(PAYLOAD)-1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.ranges = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_file(server, tmp_path):
+    path = str(tmp_path / 'model.pth')
+    download_file(server + '/model.pth', path, md5=PAYLOAD_MD5, chunk_size=4096, quiet=True)
+    assert open(path, 'rb').read() == PAYLOAD
+    assert not os.path.exists(path + '.part')
+    assert verify_file(path, PAYLOAD_MD5)
+
+
+def test_download_file_resumes_partial(server, tmp_path):
+    path = str(tmp_path / 'model.pth')
+    with open(path + '.part', 'wb') as f:
+        f.write(PAYLOAD[:100_000])
+    download_file(server + '/model.pth', path, md5=PAYLOAD_MD5, quiet=True)
+    assert RangeHandler.ranges == ['bytes=100000-']
+    assert open(path, 'rb').read() == PAYLOAD
+
+
+def test_download_file_md5_mismatch(server, tmp_path):
+    path = str(tmp_path / 'model.pth')
+    with pytest.raises(RuntimeError):
+        download_file(server + '/model.pth', path, md5='0' * 32, quiet=True)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+def test_download_file_from_local_mirror(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    (mirror / 'model.pth').write_bytes(PAYLOAD)
+    src = resolve_source('https://example.com/models/model.pth', str(mirror))
+    assert src == os.path.join(str(mirror), 'model.pth')
+    path = str(tmp_path / 'cache' / 'model.pth')
+    download_file(src, path, md5=PAYLOAD_MD5, quiet=True)
+    assert open(path, 'rb').read() == PAYLOAD
+
+
+def test_resolve_source_base_url():
+    url = 'https://example.com/models/model.pth'
+    assert resolve_source(url) == url
+    assert resolve_source(url, 'http://mirror.local/blip/') == 'http://mirror.local/blip/model.pth'
@@ -0,0 +1,33 @@
+from src.clip_interrogator.clip_interrogator import ClipInterrogator
+from src.clip_interrogator.cli import main, parse_overrides
+from src.clip_interrogator.evaluate import TABLES, evaluate
+from src.clip_interrogator.testing import random_images, tiny_config
+
+
+def test_identical_configurations(tiny_ci):
+    report = evaluate(tiny_ci, tiny_ci, random_images(2), mode='fast', top_count=5, max_flavors=4)
+    assert report['count'] == 2
+    assert report['recall'] == {name: 1.0 for name in TABLES}
+    assert report['prompt_recall'] == 1.0
+    assert report['similarity']['delta'] == 0.0
+    assert report['latency_ms']['candidate']['p95'] > 0
+
+
+def test_candidate_configuration(tiny_ci, tmp_path):
+    # chunked ranking only keeps chunk_size / num_chunks labels per chunk
+    candidate = ClipInterrogator(tiny_config(str(tmp_path / 'candidate'), chunk_size=16))
+    report = evaluate(tiny_ci, candidate, random_images(2), mode='best', candidate_mode='fast', max_flavors=4)
+    assert report['candidate_mode'] == 'fast'
+    assert all(0.0 <= recall <= 1.0 for recall in report['recall'].values())
+    row = report['images'][0]
+    assert row['similarity_delta'] == row['candidate_similarity'] - row['reference_similarity']
+    assert report['speedup'] > 0
+
+
+def test_evaluate_command(tmp_path, capsys):
+    output = tmp_path / 'report.json'
+    main(['evaluate', '--tiny', '--tiny-labels', '32', '--synthetic', '2', '--candidate', 'chunk_size=8',
+          '--mode', 'fast', '--max-flavors', '4', '--cache-path', str(tmp_path), '-o', str(output)])
+    assert '"recall"' in capsys.readouterr().out
+    assert output.exists()
+    assert parse_overrides(['chunk_size=512', 'quantize=true', 'device=cpu']) == {'chunk_size': 512, 'quantize': True, 'device': 'cpu'}
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+HEAVY_MODULES = ['numpy', 'open_clip', 'requests', 'timm', 'torch', 'torchvision', 'tqdm', 'transformers']
+IMPORT_BUDGET_US = 500_000
+
+
+def _import_profile(statement: str):
+    # -X importtime reports the cumulative import cost of every module on stderr
+    code = f"import sys; {statement}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=SRC_PATH, capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative_us, name = line[len('import time:'):].split('|')
+            if cumulative_us.strip().isdigit():
+                cumulative[name.strip()] = int(cumulative_us)
+    return [m for m in result.stdout.strip().split(',') if m], cumulative
+
+
+def test_import_is_lazy():
+    loaded, cumulative = _import_profile('import clip_interrogator')
+    assert loaded == []
+    assert cumulative['clip_interrogator'] < IMPORT_BUDGET_US
+
+
+def test_predict_sample_import_is_lazy():
+    loaded, _ = _import_profile('from clip_interrogator.predict_sample import create_source_list')
+    assert loaded == []
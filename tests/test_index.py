@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from src.clip_interrogator.batch import iter_images, run_batch
+from src.clip_interrogator.index import FEATURES_FILE, ImageIndex, _exact_chunk_size
+from src.clip_interrogator.testing import random_images
+
+
+def test_search_is_exact_over_chunks(tiny_ci, tmp_path):
+    features = torch.nn.functional.normalize(torch.randn(500, 32), dim=-1)
+    index = ImageIndex(str(tmp_path / 'index'))
+    for start in range(0, 500, 100):
+        index.add([f"img{i}" for i in range(start, start + 100)], features[start:start + 100])
+        index.flush()
+    tiny_ci.config.chunk_size = 16
+
+    query = torch.nn.functional.normalize(torch.randn(1, 32), dim=-1)
+    expected = (features.half().float() @ query.T)[:, 0].topk(10).indices.tolist()
+    results = ImageIndex(str(tmp_path / 'index')).search(tiny_ci, query, top_count=10)
+    assert [id for id, _ in results] == [f"img{i}" for i in expected]
+    assert all(a[1] >= b[1] for a, b in zip(results, results[1:]))
+
+    # rows flushed without their ids are dropped on open
+    with open(tmp_path / 'index' / FEATURES_FILE, 'ab') as f:
+        f.write(b'\0' * 64 * 3)
+    assert len(ImageIndex(str(tmp_path / 'index'))) == 500
+    assert os.path.getsize(tmp_path / 'index' / FEATURES_FILE) == 500 * 64
+
+
+def test_search_keeps_top_rows_of_one_chunk(tiny_ci, tmp_path):
+    # the true top 10 all sit in the first chunk
+    torch.manual_seed(0)
+    query = torch.nn.functional.normalize(torch.randn(1, 32), dim=-1)
+    near = torch.nn.functional.normalize(query + 0.01 * torch.arange(1, 11)[:, None] * torch.randn(10, 32), dim=-1)
+    features = torch.cat([near, torch.nn.functional.normalize(torch.randn(490, 32), dim=-1)])
+    index = ImageIndex(str(tmp_path / 'index'))
+    index.add([f"img{i}" for i in range(500)], features)
+    index.flush()
+    tiny_ci.config.chunk_size = 16
+
+    expected = (features.half().float() @ query.T)[:, 0].topk(10).indices.tolist()
+    assert sorted(expected) == list(range(10))
+    assert [id for id, _ in index.search(tiny_ci, query, top_count=10)] == [f"img{i}" for i in expected]
+
+    for rows, top_count, chunk_size in [(500, 10, 16), (1_000_000, 10, 2048), (10_000, 100, 64), (50, 10, 2048)]:
+        size = _exact_chunk_size(rows, top_count, chunk_size)
+        assert size >= rows or int(size / -(-rows // size)) >= top_count
+
+
+def test_batch_builds_searchable_index(tiny_ci, tmp_path):
+    source = tmp_path / 'images'
+    source.mkdir()
+    images = random_images(3)
+    for i, image in enumerate(images):
+        image.save(str(source / f"{i}.png"))
+    index_path = str(tmp_path / 'index')
+    run_batch(tiny_ci, iter_images(str(source)), str(tmp_path / 'out.jsonl'), mode='caption', index_path=index_path)
+
+    index = ImageIndex(index_path)
+    assert len(index) == 3 and index.model == tiny_ci.config.clip_model_name
+    assert index.search(tiny_ci, images[1], top_count=1)[0][0] == str(source / '1.png')
+    assert len(index.search(tiny_ci, 'a photo of a cat', top_count=5)) == 3
+
+
+def test_concurrent_writers_keep_rows_and_ids_aligned(tmp_path):
+    # one row per id, its first value encodes the id
+    path = str(tmp_path / 'index')
+    def write(worker):
+        index = ImageIndex(path)
+        for start in range(0, 40, 4):
+            rows = range(worker * 100 + start, worker * 100 + start + 4)
+            features = torch.zeros(4, 8)
+            features[:, 0] = torch.tensor([float(i) for i in rows])
+            index.add([str(i) for i in rows], features)
+            index.flush()
+        return index
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        writers = list(pool.map(write, range(4)))
+
+    index = ImageIndex(path)
+    assert len(index) == 160 and all(len(writer) >= 40 for writer in writers)
+    assert [float(row[0]) for row in index.features()] == [float(id) for id in index.ids]
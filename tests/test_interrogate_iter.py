@@ -0,0 +1,31 @@
+import time
+import pytest
+from src.clip_interrogator.budget import Budget
+from src.clip_interrogator.tracing import Tracer
+
+
+def test_steps_end_with_interrogate_result(tiny_ci, images):
+    steps = list(tiny_ci.interrogate_iter(images[0], max_flavors=4))
+    assert [step.stage for step in steps[:2]] == ['caption', 'check_multi_batch']
+    assert all(step.stage == 'flavor_chain' for step in steps[2:]) and len(steps) <= 6
+    assert steps[0].prompt == tiny_ci.generate_caption(images[0])
+    assert steps[-1].prompt == tiny_ci.interrogate(images[0], max_flavors=4)
+    for before, after in zip(steps[1:], steps[2:]):
+        assert after.prompt.startswith(before.prompt + ', ') and after.similarity > before.similarity
+
+
+def test_stopping_early_skips_remaining_work(tiny_ci, images, monkeypatch):
+    steps = tiny_ci.interrogate_iter(images[0])
+    assert next(steps).stage == 'caption'
+    monkeypatch.setattr(tiny_ci.flavors, 'rank_indices', lambda *args: pytest.fail("ranked after cancel"))
+    steps.close()
+
+
+def test_time_holding_a_step_is_not_charged(tiny_ci, images):
+    expected = tiny_ci.interrogate(images[0], max_flavors=4)
+    budget = Budget(seconds=0.8)
+    with Tracer() as tracer:
+        for step in tiny_ci.interrogate_iter(images[0], max_flavors=4, budget=budget):
+            time.sleep(0.5)
+    assert step.prompt == expected and not budget.report()['exhausted']
+    assert tracer.report()['flavor_chain']['seconds'] < 0.5
@@ -0,0 +1,47 @@
+import os
+import pickle
+import numpy as np
+from src.clip_interrogator.clip_interrogator import ClipInterrogator, LabelTable
+from src.clip_interrogator.testing import tiny_config
+
+
+def test_cached_embeds_are_memory_mapped(tiny_ci, images):
+    assert isinstance(tiny_ci.flavors.embeds, np.memmap)
+    assert tiny_ci.flavors.embeds.dtype == np.float32
+
+    ci = ClipInterrogator(tiny_ci.config)
+    ci.prepare_labels()
+    assert isinstance(ci.flavors.embeds, np.memmap)
+    assert ci.flavors.embeds.filename == tiny_ci.flavors.embeds.filename
+    assert ci.interrogate_fast(images[0]) == tiny_ci.interrogate_fast(images[0])
+    assert isinstance(ci.merged.embeds, np.memmap)
+
+
+def test_uncached_table_ranks_the_same(tiny_ci, images):
+    labels = tiny_ci.flavors.labels
+    table = LabelTable(labels, None, tiny_ci.clip_model, tiny_ci.tokenize, tiny_ci.config)
+    assert not isinstance(table.embeds, np.memmap)
+    np.testing.assert_allclose(table.embeds, tiny_ci.flavors.embeds)
+
+    features = tiny_ci.image_to_features(images[0])
+    assert table.rank(features, 5) == tiny_ci.flavors.rank(features, 5)
+
+
+def test_legacy_pickle_is_migrated(tmp_path):
+    config = tiny_config(str(tmp_path))
+    ci = ClipInterrogator(config)
+    ci.prepare_labels()
+    path = ci.flavors.embeds.filename
+    embeds = np.array(ci.flavors.embeds)
+    pkl = path[:-len('.float32.npy')] + '.pkl'
+    with open(pkl, 'rb') as f:
+        data = pickle.load(f)
+    data['embeds'] = list(embeds.astype(np.float16))
+    with open(pkl, 'wb') as f:
+        pickle.dump(data, f)
+    os.remove(path)
+
+    ci = ClipInterrogator(config)
+    ci.prepare_labels()
+    assert os.path.exists(path)
+    np.testing.assert_allclose(ci.flavors.embeds, embeds, atol=1e-3)
@@ -0,0 +1,92 @@
+import asyncio
+import torch
+from src.clip_interrogator.pipeline import MicroBatcher, ResultWriter, load_image, prefetch_images
+from src.clip_interrogator.testing import random_images
+
+
+def _write_images(tmp_path, count=5):
+    paths = []
+    for i, image in enumerate(random_images(count, size=256)):
+        path = str(tmp_path / f"{i}.jpg")
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+def test_load_image_draft(tmp_path):
+    path = _write_images(tmp_path, 1)[0]
+    assert load_image(path).size == (256, 256)
+    assert load_image(path, draft_size=64).size == (64, 64)
+    assert load_image(path, draft_size=100).size == (128, 128)
+
+
+def test_prefetch_images(tmp_path):
+    paths = _write_images(tmp_path)
+    (tmp_path / 'broken.jpg').write_bytes(b'not an image')
+    paths.insert(2, str(tmp_path / 'broken.jpg'))
+
+    results = list(prefetch_images(paths, workers=2, prefetch=2))
+    assert [path for path, _, _ in results] == paths
+    assert results[2][1] is None and results[2][2] is not None
+    assert all(image.mode == 'RGB' for _, image, error in results if error is None)
+
+
+def test_prefetch_prepares_model_inputs(tiny_ci, tmp_path):
+    paths = _write_images(tmp_path)
+    results = list(prefetch_images(paths, workers=2, prefetch=2, prepare=tiny_ci.prepare_image))
+    prepared = [image for _, image, _ in results]
+    images = [load_image(path) for path in paths]
+    assert all(p.blip is not None and p.clip is not None for p in prepared)
+    assert tiny_ci.generate_captions(prepared) == tiny_ci.generate_captions(images)
+    assert torch.equal(tiny_ci.images_to_features(prepared), tiny_ci.images_to_features(images))
+    assert tiny_ci.interrogate_fast(prepared[0]) == tiny_ci.interrogate_fast(images[0])
+
+
+def test_result_writer():
+    written = []
+    with ResultWriter(written.append, maxsize=2) as writer:
+        for i in range(10):
+            writer.put(i)
+    assert written == list(range(10))
+
+
+def test_micro_batcher_coalesces_concurrent_calls():
+    batches = []
+    def double(items):
+        batches.append(len(items))
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(double, max_batch_size=4, max_wait=0.05)
+        return await asyncio.gather(*[batcher.submit(i) for i in range(10)])
+
+    assert asyncio.run(run()) == [i * 2 for i in range(10)]
+    assert batches == [4, 4, 2]
+
+
+def test_micro_batcher_errors_reach_every_caller():
+    def fail(items):
+        raise ValueError("boom")
+
+    async def run():
+        batcher = MicroBatcher(fail, max_batch_size=4)
+        return await asyncio.gather(*[batcher.submit(i) for i in range(3)], return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(run()))
+
+
+def test_micro_batcher_isolates_a_failing_item():
+    batches = []
+    def double(items):
+        batches.append(len(items))
+        if 3 in items:
+            raise ValueError("bad item")
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(double, max_batch_size=4, max_wait=0.05)
+        return await asyncio.gather(*[batcher.submit(i) for i in range(4)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[:3] == [0, 2, 4] and isinstance(results[3], ValueError)
+    assert batches == [4, 1, 1, 1, 1]
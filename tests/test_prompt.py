@@ -0,0 +1,88 @@
+import os
+import pickle
+import random
+import numpy as np
+import pytest
+from src.clip_interrogator.clip_interrogator import ClipInterrogator, LabelTable
+from src.clip_interrogator.prompt import PromptBuilder, TokenCounter, truncate_to_fit
+
+
+def test_incremental_counts_match_tokenizer(tiny_ci):
+    counter, encode = tiny_ci.token_counter, tiny_ci.tokenize.encode
+    assert counter.incremental
+    labels = tiny_ci.flavors.labels + tiny_ci.artists.labels + ['(bracketed)', "it's", 'f/1.8', 'x!']
+    random.seed(0)
+    for _ in range(50):
+        prompt = PromptBuilder(counter, 'a photo of a cat')
+        for label in random.sample(labels, 12):
+            prompt = prompt.extended(label)
+            assert prompt.tokens == len(encode(prompt.text))
+        assert prompt.at_max_len == (tiny_ci.tokenize([prompt.text])[0][-1] != 0)
+
+
+def test_token_lengths_seed_the_counter(tiny_ci):
+    table = tiny_ci.flavors
+    assert [int(n) for n in table.token_lengths] == [len(tiny_ci.tokenize.encode(l)) for l in table.labels]
+    assert tiny_ci.token_counter.cache[table.labels[0]] == table.token_lengths[0]
+
+    # tables cached before token lengths were stored get them on load
+    cache_filepath = table.embeds.filename[:-len('.float32.npy')] + '.pkl'
+    with open(cache_filepath, 'rb') as f:
+        data = pickle.load(f)
+    del data['token_lengths']
+    with open(cache_filepath, 'wb') as f:
+        pickle.dump(data, f)
+    ci = ClipInterrogator(tiny_ci.config)
+    ci.prepare_labels()
+    assert list(ci.flavors.token_lengths) == list(table.token_lengths)
+
+
+def test_counts_of_other_text_are_bounded(tiny_ci):
+    counter = TokenCounter(tiny_ci.tokenize, recent_size=4)
+    counter.update(tiny_ci.flavors.labels, tiny_ci.flavors.token_lengths)
+    texts = [f"a photo of {i} cats" for i in range(10)]
+    assert counter.counts(texts) == [len(tiny_ci.tokenize.encode(t)) for t in texts]
+    assert list(counter.recent) == texts[-4:]
+    assert len(counter.cache) == len(set(tiny_ci.flavors.labels))
+
+
+def test_truncate_to_fit(tiny_ci):
+    text = ', '.join(['a photo of a cat'] + tiny_ci.flavors.labels)
+    prompt = truncate_to_fit(text, tiny_ci.token_counter)
+    assert text.startswith(prompt) and prompt != text
+    assert tiny_ci.tokenize([prompt])[0][-1] == 0
+    next_part = text[len(prompt) + 2:].split(', ')[0]
+    assert tiny_ci.tokenize([prompt + ', ' + next_part])[0][-1] != 0
+
+    # tokenizers without encode fall back to tokenizing the whole prompt
+    fallback = TokenCounter(lambda texts: tiny_ci.tokenize(texts))
+    assert not fallback.incremental
+    assert truncate_to_fit(text, fallback) == prompt
+
+
+def test_assembled_tokens_match_tokenizer(tiny_ci):
+    table = tiny_ci.flavors
+    labels = table.labels + ['(bracketed)', "it's", 'f/1.8', 'x!', '']
+    counter = tiny_ci.token_counter
+    ids, lengths = counter.split(tiny_ci.tokenize(labels))
+    assert (counter.assemble(ids, lengths) == tiny_ci.tokenize(labels).numpy()).all()
+    long_prompt = ', '.join(['a photo of a cat'] + table.labels[:40])
+    for prefix in ['a photo of a cat', 'a cat!', long_prompt]:
+        expected = tiny_ci.tokenize([f"{prefix}, {label}" for label in labels]).numpy()
+        assert (counter.assemble(ids, lengths, prefix, labels) == expected).all()
+
+    indices = list(range(len(table.labels)))
+    expected = tiny_ci.tokenize([f"a cat, {label}" for label in table.labels])
+    assert table.label_tokens(indices, prefix='a cat').equal(expected)
+
+
+def test_token_ids_persist_with_table(tiny_ci, monkeypatch):
+    table = tiny_ci.flavors
+    assert table.tokens.filename.endswith('.tokens.npy')
+    # missing embeddings, e.g. for another precision, are encoded from the stored ids without BPE
+    embeds_filepath = table.embeds.filename
+    os.remove(embeds_filepath)
+    monkeypatch.setattr(TokenCounter, 'split', lambda *args: pytest.fail("labels were tokenized again"))
+    rebuilt = LabelTable(table.labels, 'flavors', tiny_ci.clip_model, tiny_ci.tokenize, tiny_ci.config)
+    assert os.path.exists(embeds_filepath)
+    assert np.allclose(rebuilt.embeds, table.embeds, atol=1e-3)
@@ -0,0 +1,53 @@
+import itertools
+import math
+import torch
+from unittest.mock import patch
+from src.clip_interrogator.clip_interrogator import ClipInterrogator, _prune_candidates
+from src.clip_interrogator.evaluate import evaluate
+from src.clip_interrogator.testing import tiny_config
+from src.clip_interrogator.tracing import Tracer
+
+
+def _normalize(x):
+    return torch.nn.functional.normalize(x, dim=-1)
+
+
+def test_prune_candidates():
+    torch.manual_seed(0)
+    embeds = _normalize(torch.randn(50, 16))
+    image, caption = _normalize(torch.randn(1, 16)), _normalize(torch.randn(1, 16))
+    relevance = (embeds @ image.T)[:, 0]
+    assert _prune_candidates(image, caption, embeds, 5, 0.0, 2.0) == relevance.topk(5).indices.tolist()
+
+    # near-synonyms of the caption or of a kept candidate are dropped
+    best = int(relevance.argmax())
+    synonyms = torch.cat([embeds, embeds[best:best+1], caption])
+    kept = _prune_candidates(image, caption, synonyms, 52, 0.3, 0.95)
+    assert kept[0] == best and 50 not in kept and 51 not in kept and len(kept) <= 50
+
+
+def test_pruned_chain_and_its_effect(tiny_ci, images, tmp_path):
+    pruned = ClipInterrogator(tiny_config(str(tmp_path / 'pruned'), flavor_prune_count=8))
+    pruned.prepare_labels()
+    with Tracer() as tracer:
+        prompt = pruned.interrogate(images[0], max_flavors=4)
+    report = tracer.report()['flavor_prune']
+    assert report['kept'] <= 8 < report['candidates']
+    assert prompt.startswith(pruned.generate_caption(images[0]))
+
+    result = evaluate(tiny_ci, pruned, images[:1], max_flavors=4, warmup=False)
+    similarity = result['similarity']
+    assert set(similarity) == {'reference', 'candidate', 'delta'}
+    assert all(math.isfinite(value) for value in similarity.values())
+    # same seeded weights, so the pruned chain only ever improves on the caption
+    assert similarity['candidate'] >= tiny_ci.similarity(tiny_ci.image_to_features(images[0]), tiny_ci.generate_caption(images[0])) - 1e-6
+    assert abs(similarity['delta']) < 0.1
+
+
+def test_chain_stops_when_pruned_candidates_run_out(tmp_path, images):
+    # every similarity beats the last, so the chain accepts each pruned candidate
+    ci = ClipInterrogator(tiny_config(str(tmp_path), flavor_prune_count=2))
+    ci.prepare_labels()
+    with patch.object(ci, 'similarity', side_effect=itertools.count()):
+        steps = list(ci.interrogate_iter(images[0], max_flavors=8))
+    assert [step.stage for step in steps] == ['caption', 'check_multi_batch', 'flavor_chain', 'flavor_chain']
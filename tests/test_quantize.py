@@ -0,0 +1,22 @@
+import torch
+from src.clip_interrogator.clip_interrogator import ClipInterrogator
+from src.clip_interrogator.quantize import validation_report
+from src.clip_interrogator.testing import tiny_config
+
+
+def test_quantize(tiny_ci, images, tmp_path):
+    quantized = ClipInterrogator(tiny_config(str(tmp_path), quantize=True))
+    assert not any(type(m) is torch.nn.Linear for m in quantized.clip_model.transformer.modules())
+    assert not any(type(m) is torch.nn.Linear for m in quantized.blip_model.text_decoder.modules())
+
+    report = validation_report(tiny_ci, quantized, images, top_count=5)
+    assert len(report['images']) == len(images)
+    assert set(report['recall']) == {'artists', 'flavors', 'mediums', 'movements', 'trendings'}
+    assert report['feature_cosine'] > 0.99
+    assert quantized.interrogate(images[0], max_flavors=2)
+
+
+def test_cpu_bf16(tmp_path, images):
+    ci = ClipInterrogator(tiny_config(str(tmp_path), cpu_bf16=True))
+    ci.prepare_labels()
+    assert ci.interrogate_fast(images[0], max_flavors=2)
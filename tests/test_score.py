@@ -0,0 +1,30 @@
+import torch
+from src.clip_interrogator.clip_interrogator import ScoreResult
+
+
+def test_score_list_matches_per_option_encoding(tiny_ci, images):
+    options = tiny_ci.flavors.labels[:20] + ['a cat', 'a cat']
+    result = tiny_ci.interragate_score_list(images[0], options)
+    assert list(result) == list(dict.fromkeys(options))
+
+    image_features = tiny_ci.image_to_features(images[0])
+    for option in options:
+        with torch.no_grad():
+            features = tiny_ci.clip_model.encode_text(tiny_ci.tokenize([option]))
+            features /= features.norm(dim=-1, keepdim=True)
+        assert abs(result[option] - (features @ image_features.T).item()) < 1e-4
+
+
+def test_score_matrix_and_text_cache(tiny_ci, images, monkeypatch):
+    options = ['a cat', 'a dog', 'a bird']
+    result = tiny_ci.score(images, options)
+    assert isinstance(result, ScoreResult) and result.scores.shape == (len(images), 3)
+    assert result.to_dict(1) == dict(zip(options, result.scores[1].tolist()))
+    assert result.top(3, image=0) == sorted(options, key=lambda o: -result.to_dict(0)[o])
+
+    encoded = []
+    encode_texts = tiny_ci.encode_texts
+    monkeypatch.setattr(tiny_ci, 'encode_texts', lambda texts, *args: encoded.append(texts) or encode_texts(texts, *args))
+    again = tiny_ci.score(tiny_ci.images_to_features(images), options + ['a fish'])
+    assert encoded == [['a fish']]
+    assert abs(again.scores[:, :3] - result.scores).max() < 1e-5
@@ -0,0 +1,111 @@
+import base64
+import io
+import json
+import queue
+import threading
+import urllib.error
+import urllib.request
+from src.clip_interrogator.serve import Job, Scheduler, make_server
+from src.clip_interrogator.testing import random_images
+
+
+def _start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_serve_loopback(tiny_ci):
+    server = make_server(tiny_ci, port=0, quiet=True)
+    url = _start(server)
+    try:
+        image = random_images(1)[0]
+        status, body = _post(url + '/interrogate', {'image': _encode(image), 'mode': 'fast'})
+        assert status == 200 and not body['cached']
+        assert body['prompt'] == tiny_ci.interrogate_fast(image)
+        status, body = _post(url + '/interrogate', {'image': _encode(image), 'mode': 'fast', 'priority': 'bulk'})
+        assert status == 200 and body['cached']
+
+        status, body = _post(url + '/flavors', {'image': _encode(image), 'max_flavors': 3})
+        assert status == 200 and len(body['prompt'].split(', ')) == 3
+
+        status, body = _post(url + '/score', {'image': _encode(image), 'texts': ['a cat', 'a dog']})
+        assert status == 200 and set(body['scores']) == {'a cat', 'a dog'}
+        status, body = _post(url + '/score', {'image': _encode(image), 'texts': ['a cat\na dog']})
+        assert status == 200 and not body['cached'] and set(body['scores']) == {'a cat\na dog'}
+
+        assert _post(url + '/interrogate', {'image': 'not base64!', 'mode': 'fast'})[0] == 400
+        assert _post(url + '/interrogate', {'image': _encode(image), 'mode': 'nope'})[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.scheduler.close()
+
+
+def test_scheduler_batches_and_prioritizes(tiny_ci):
+    scheduler = Scheduler(tiny_ci, batch_size=4, queue_size=4)
+    images = random_images(5)
+    bulk = [scheduler.submit(Job(('interrogate', 'fast', None), image), 'bulk') for image in images[:3]]
+    interactive = scheduler.submit(Job(('interrogate', 'caption', None), images[3]))
+    batch = scheduler._next_batch()
+    assert [job.future for job in batch] == [interactive]
+    assert len(scheduler._next_batch()) == 3
+
+    for image in images[:4]:
+        scheduler.submit(Job(('interrogate', 'fast', None), image), 'bulk')
+    try:
+        scheduler.submit(Job(('interrogate', 'fast', None), images[4]), 'bulk')
+        assert False
+    except queue.Full:
+        pass
+
+
+def test_serve_backpressure(tiny_ci):
+    # the scheduler is never started, so the first queued job fills the lane
+    scheduler = Scheduler(tiny_ci, queue_size=1)
+    scheduler.submit(Job(('interrogate', 'fast', None), random_images(1)[0]))
+    server = make_server(tiny_ci, port=0, quiet=True, scheduler=scheduler)
+    url = _start(server)
+    try:
+        status, body = _post(url + '/interrogate', {'image': _encode(random_images(1)[0]), 'mode': 'fast'})
+        assert status == 429
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_scheduler_close_fails_pending_jobs(tiny_ci):
+    scheduler = Scheduler(tiny_ci)
+    futures = [scheduler.submit(Job(('interrogate', 'fast', None), image), lane)
+               for image, lane in zip(random_images(2), ('interactive', 'bulk'))]
+    scheduler.close()
+    for future in futures:
+        assert isinstance(future.exception(timeout=1), Exception)
+    assert scheduler.depths() == {'interactive': 0, 'bulk': 0}
+
+
+def test_scheduler_isolates_a_failing_job(tiny_ci):
+    scheduler = Scheduler(tiny_ci, batch_size=4)
+    images = random_images(3)
+    futures = [scheduler.submit(Job(('interrogate', 'caption', None), image)) for image in images]
+    futures.append(scheduler.submit(Job(('interrogate', 'caption', None), 'not an image')))
+    scheduler.start()
+    try:
+        assert [future.result(timeout=60) for future in futures[:3]] == [tiny_ci.generate_caption(image) for image in images]
+        assert isinstance(futures[3].exception(timeout=60), Exception)
+    finally:
+        scheduler.close()
@@ -0,0 +1,76 @@
+import json
+import os
+from src.clip_interrogator.shard import (core_groups, launch, launch_commands, merge_outputs, parse_shard,
+                                         shard_output_path, shard_paths)
+
+
+def test_shard_paths_partition():
+    source = os.path.abspath('data')
+    paths = [os.path.join(source, f"{i}.jpg") for i in range(200)]
+    shards = [list(shard_paths(paths, source, i, 4)) for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(paths)
+    assert all(shards)
+    assert shards == [list(shard_paths(paths, source, i, 4)) for i in range(4)]
+
+    # the partition only depends on the path relative to the walked directory
+    moved = [os.path.join('/mnt/other', f"{i}.jpg") for i in range(200)]
+    assert [os.path.basename(p) for p in shard_paths(moved, '/mnt/other', 1, 4)] == \
+           [os.path.basename(p) for p in shards[1]]
+
+
+def test_parse_shard():
+    assert parse_shard('2/8') == (2, 8)
+    for spec in ('8/8', 'a/b', '1'):
+        try:
+            parse_shard(spec)
+            assert False, spec
+        except Exception:
+            pass
+
+
+def test_shard_output_path():
+    assert shard_output_path('out/prompts.jsonl', 3, 16) == 'out/prompts.shard-00003-of-00016.jsonl'
+
+
+def test_launch_commands():
+    commands = launch_commands(['images', '-o', 'out.jsonl'], procs=2, node=(1, 3))
+    assert len(commands) == 2
+    for i, (cmd, env, group) in enumerate(commands):
+        shard = cmd[cmd.index('--shard') + 1]
+        assert shard == f"{2 + i}/6"
+        assert env['OMP_NUM_THREADS'] == str(len(group))
+
+
+def test_core_groups():
+    cores = len(sum(core_groups(1), []))
+    groups = core_groups(2)
+    assert len(groups) == 2 and all(groups)
+    assert len(core_groups(cores + 1)) == cores + 1
+    if cores >= 2:
+        cpus = sum(groups, [])
+        assert len(cpus) == len(set(cpus))
+
+
+def test_merge_outputs(tmp_path):
+    a, b = tmp_path / 'a.jsonl', tmp_path / 'b.jsonl'
+    a.write_text('\n'.join(json.dumps(r) for r in [
+        {'path': '/x/2.jpg', 'hash': 'h2', 'mode': 'best', 'prompt': None, 'error': 'oom'},
+        {'path': '/x/1.jpg', 'hash': 'h1', 'mode': 'best', 'prompt': 'one', 'error': None},
+    ]) + '\n{"path": "/x/')
+    b.write_text(json.dumps({'path': '/x/2.jpg', 'hash': 'h2', 'mode': 'best', 'prompt': 'two', 'error': None}) + '\n')
+    stats = merge_outputs([str(a), str(b)], str(tmp_path / 'merged.jsonl'))
+    assert stats == {'inputs': 2, 'records': 2, 'failed': 0}
+    rows = [json.loads(line) for line in open(tmp_path / 'merged.jsonl')]
+    assert [row['prompt'] for row in rows] == ['one', 'two']
+
+
+def test_launch_return_code(monkeypatch):
+    codes = iter([0, -9, 3])
+    class Worker:
+        def __init__(self, *args, **kwargs):
+            self.code = next(codes)
+        def wait(self):
+            return self.code
+    monkeypatch.setattr('src.clip_interrogator.shard.launch_commands', lambda *args: [([], {}, [0])] * 3)
+    monkeypatch.setattr('subprocess.Popen', Worker)
+    assert launch([], procs=3) == 1
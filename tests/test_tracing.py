@@ -0,0 +1,74 @@
+import json
+import logging
+import time
+import pytest
+from types import SimpleNamespace
+from src.clip_interrogator.profiling import MemoryProfiler
+from src.clip_interrogator.tracing import Tracer, log_exporter, stage
+
+
+def test_tracer_records_stages(tiny_ci, images):
+    ended = []
+    with Tracer(on_stage=lambda name, seconds, counts: ended.append(name)) as tracer:
+        tiny_ci.interrogate(images[0], max_flavors=2)
+    report = tracer.report()
+
+    for name in ('interrogate', 'caption', 'image_features', 'rank', 'rank:flavors', 'encode_text', 'flavor_chain'):
+        assert report[name]['calls'] >= 1 and report[name]['seconds'] >= 0, name
+    assert report['caption']['images'] == 1
+    assert report['encode_text']['strings'] > 0 and report['encode_text']['tokens'] > 0
+    assert 1 <= report['flavor_chain']['iterations'] <= 2
+    assert report['interrogate']['seconds'] >= report['flavor_chain']['seconds']
+    assert ended[-1] == 'interrogate'
+
+
+def test_tracing_disabled_outside_tracer(tiny_ci, images):
+    assert not stage('caption')
+    with Tracer() as tracer:
+        pass
+    tiny_ci.interrogate_fast(images[0])
+    assert tracer.report() == {}
+
+
+def test_log_exporter(tiny_ci, images, caplog):
+    with caplog.at_level(logging.INFO, logger='clip_interrogator.trace'):
+        with Tracer(exporter=log_exporter()):
+            tiny_ci.interrogate_fast(images[0])
+    record = caplog.records[-1]
+    assert record.trace['interrogate_fast']['calls'] == 1
+    assert json.loads(record.getMessage()[len('trace '):]) == record.trace
+
+
+def test_memory_profiler(tiny_ci, images):
+    with MemoryProfiler(interval=0.001) as profiler:
+        tiny_ci.interrogate(images[0], max_flavors=2)
+    report = profiler.report()
+    assert report['rank:flavors']['peak_rss_bytes'] > 0
+    assert report['caption']['rss_growth_bytes'] >= 0
+    assert report['interrogate']['peak_rss_bytes'] >= report['caption']['peak_rss_bytes']
+    summary = profiler.summary()
+    assert summary.splitlines()[0].split()[:2] == ['stage', 'calls']
+    assert 'flavor_chain' in summary
+
+
+def test_memory_profiler_cpu_allocations(tiny_ci, images):
+    with MemoryProfiler(cuda=False, cpu_allocations=True) as profiler:
+        tiny_ci.interrogate(images[0], max_flavors=2)
+    report = profiler.report()
+    assert report['flavor_chain']['cpu_allocated_bytes'] > 0
+    assert 0 < report['flavor_chain']['cpu_alloc_peak_bytes'] <= report['flavor_chain']['cpu_allocated_bytes']
+    assert 'cpu alloc peak MB' in profiler.summary()
+
+
+def test_memory_profiler_without_memory_events():
+    profiler = MemoryProfiler(cuda=False, cpu_allocations=True)
+    profiler.profile_start_ns = time.time_ns()
+    profiler.torch_profiler = SimpleNamespace(profiler=SimpleNamespace())
+    with pytest.warns(UserWarning, match='cpu_allocations'):
+        assert profiler._memory_events() is None
+
+    # timestamps on another clock can't be matched to stages
+    results = SimpleNamespace(trace_start_ns=lambda: 10**9, events=lambda: [])
+    profiler.torch_profiler = SimpleNamespace(profiler=SimpleNamespace(kineto_results=results))
+    with pytest.warns(UserWarning, match='wall clock'):
+        assert profiler._memory_events() is None
@@ -0,0 +1,29 @@
+import sys
+import pytest
+from src.clip_interrogator.video import interrogate_frames, read_video
+from src.clip_interrogator.testing import random_images
+
+
+def test_segments_follow_scene_changes(tiny_ci, monkeypatch):
+    a, b = random_images(2)
+    frames = [(i * 0.5, image) for i, image in enumerate([a, a, a, b, b, a, a])]
+    interrogated = []
+    fast = tiny_ci.interrogate_fast
+    monkeypatch.setattr(tiny_ci, 'interrogate_fast', lambda image, **kwargs: interrogated.append(image) or fast(image, **kwargs))
+
+    # the random-weight model finds all noise images alike, identical frames are closer still
+    segments = list(interrogate_frames(tiny_ci, frames, mode='fast', threshold=0.995, batch_size=2))
+    assert [(s.start, s.end) for s in segments] == [(0, 2), (3, 4), (5, 6)]
+    assert [(s.start_time, s.end_time) for s in segments] == [(0.0, 1.0), (1.5, 2.0), (2.5, 3.0)]
+    assert len(interrogated) == 3
+    assert segments[0].prompt == segments[2].prompt == tiny_ci.interrogate_fast(a)
+
+    # plain images work too and a threshold of 0 keeps one segment
+    segments = list(interrogate_frames(tiny_ci, [a, b, a], mode='caption', threshold=0))
+    assert [(s.start, s.end, s.start_time) for s in segments] == [(0, 2, None)]
+
+
+def test_read_video_requires_pyav(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'av', None)
+    with pytest.raises(Exception, match="PyAV"):
+        next(read_video('clip.mp4'))